@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 # 为了解决import出错
 import os
@@ -8,29 +9,9 @@ import sys
 sys.path.append(os.path.abspath(os.path.dirname(__file__)+'/'+'..'))
 
 # 使用绝对路径引入自己的包
-from Derivable_Models.Gan_Utils import get_gan_model
-
-
-PGGAN_LATENT_1024 = [(512, 1, 1),
-              (512, 4, 4), (512, 4, 4),
-              (512, 8, 8), (512, 8, 8),
-              (512, 16, 16), (512, 16, 16),
-              (512, 32, 32), (512, 32, 32),
-              (256, 64, 64), (256, 64, 64),
-              (128, 128, 128), (128, 128, 128),
-              (64, 256, 256), (64, 256, 256),
-              (32, 512, 512), (32, 512, 512),
-              (16, 1024, 1024), (16, 1024, 1024),
-              (3, 1024, 1024)]
-
-PGGAN_LATENT_256 = [(512, 1, 1), (512, 4, 4),
-              (512, 4, 4), (512, 8, 8),
-              (512, 8, 8), (512, 16, 16),
-              (512, 16, 16), (512, 32, 32),
-              (512, 32, 32), (256, 64, 64),
-              (256, 64, 64), (128, 128, 128),
-              (128, 128, 128), (64, 256, 256),
-              (64, 256, 256), (3, 256, 256)]
+from Derivable_Models.Gan_Utils import get_gan_model, get_split_plan
+from Derivable_Models.generator_registry import placement
+
 
 PGGAN_LAYER_MAPPING = {  # The new PGGAN includes the intermediate output layer, need mapping
     0: 0, 1: 1, 2: 3, 3: 4, 4: 6, 5: 7, 6: 9, 7: 10, 8: 12
@@ -42,73 +23,219 @@ def get_derivable_generator(gan_model_name, generator_type, args):
         return PGGAN(gan_model_name)
     elif generator_type == 'PGGAN-Multi-Z':  # Multiple Latent Codes            # 默认使用此类型
         return PGGAN_multi_z(gan_model_name, args.composing_layer, args.z_number, args)
+    elif generator_type == 'PGGAN-Multi-Z-Shared':  # batch中的图片共用一组latent codes
+        return PGGAN_multi_z_shared(gan_model_name, args.composing_layer, args.z_number,
+                                    getattr(args, 'private_z_number', 0), args)
     else:
         raise Exception('Please indicate valid `generator_type`')
 
 
-class PGGAN(nn.Module):
+# 生成器的层由GENERATOR_REGISTRY在多个调用者之间共享, 不能原地移动或转换
+# .cuda()/.to()/.half()等都经过_apply(), 设备或精度改变时从缓存中取出对应的副本重新组装
+class SharedLayersMixin(object):
+    def bind_layers(self, device=None, dtype=None):
+        raise NotImplementedError
+
+    def _apply(self, fn, *args, **kwargs):
+        device, dtype = placement(self.pggan)
+        # 用空tensor得到转换后的设备和精度
+        probe = fn(torch.empty(0, device=device, dtype=dtype))
+        if (probe.device, probe.dtype) != (device, dtype):
+            self.bind_layers(probe.device, probe.dtype)
+        return super(SharedLayersMixin, self)._apply(fn, *args, **kwargs)
+
+
+class PGGAN(SharedLayersMixin, nn.Module):
     def __init__(self, gan_model_name):
         super(PGGAN, self).__init__()
-        self.pggan = get_gan_model(gan_model_name)
+        self.gan_model_name = gan_model_name
+        self.bind_layers()
         self.init = False
 
+    def bind_layers(self, device=None, dtype=None):
+        self.pggan = get_gan_model(self.gan_model_name, device, dtype)
+
     def input_size(self):
         return [(512,)]
 
-    def cuda(self, device=None):
-        self.pggan.cuda(device=device)
-
     def forward(self, z):
         latent = z[0]
-        return self.pggan(latent)
+        return self.pggan(latent.view((-1, 512, 1, 1)))
 
 # 默认类型
 # PGGAN_multi_z(gan_model_name, args.composing_layer, args.z_number, args)
-class PGGAN_multi_z(nn.Module):
+class PGGAN_multi_z(SharedLayersMixin, nn.Module):
+    can_prune_codes = True      # 支持GradientDescent.prune_codes()
+
     def __init__(self, gan_model_name, blending_layer, z_number, args):
         super(PGGAN_multi_z, self).__init__()
         self.blending_layer = blending_layer        # default = 6
         self.z_number = z_number        # latent codes的数量. default=30
         self.z_dim = 512
-        self.pggan = get_gan_model(gan_model_name)    
-
-        # generator被分成了两个子网络
-        # blending_layer即为论文中intermediate layer(中间层)
-        # 这样的划分是为了从任意给定的Zn中提取出相应的空间特征用于进一步的合成
-        self.pre_model = nn.Sequential(*list(self.pggan.children())[:blending_layer])
-        self.post_model = nn.Sequential(*list(self.pggan.children())[blending_layer:])
+        self.gan_model_name = gan_model_name
+        plan = get_split_plan(gan_model_name)
+        if not 0 < blending_layer < len(plan['layer_names']):
+            raise ValueError('`composing_layer` of `%s` should be in [1, %d], but %d received!'
+                             % (gan_model_name, len(plan['layer_names']) - 1, blending_layer))
+
+        # 显存换计算: post_model按分辨率分段, 反向传播时重新计算每段内的中间结果, 只保存段与段之间的feature map
+        # checkpoint_blocks为每段包含的分辨率数量, 0表示不使用
+        self.checkpoint_blocks = getattr(args, 'checkpoint_blocks', 0)
+        self.bind_layers()
         self.init = True
+        self.code_cache = None      # 冻结latent codes时缓存的pre_model输出
 
-
-        PGGAN_LATENT = PGGAN_LATENT_1024 if gan_model_name == 'PGGAN-CelebA' else PGGAN_LATENT_256
-        self.mask_size = PGGAN_LATENT[blending_layer][1:]
-        self.layer_c_number = PGGAN_LATENT[blending_layer][0]
+        # 组合层的feature map尺寸, 由拆分表给出
+        self.mask_size = plan['shapes'][blending_layer][1:]
+        self.layer_c_number = plan['shapes'][blending_layer][0]
 
     def input_size(self):   # 接收的参数矩阵格式
         return [(self.z_number, self.z_dim), (self.z_number, self.layer_c_number)]
 
-    def init_value(self, batch_size):
+    def init_value(self, batch_size, device='cuda'):
         # 随机生成预计值
-        z_estimate = torch.randn((batch_size, self.z_number, self.z_dim)).cuda()  # our estimate, initialized randomly
+        z_estimate = torch.randn((batch_size, self.z_number, self.z_dim), device=device)  # our estimate, initialized randomly
         # torch.full(size, fill_value, out=None, dtype=None, layout=torch.strided, device=None, requires_grad=False) → Tensor
-        z_alpha = torch.full((batch_size, self.z_number, self.layer_c_number), 1 / self.z_number).cuda()    # 全部用 1/z_number填充
+        z_alpha = torch.full((batch_size, self.z_number, self.layer_c_number), 1 / self.z_number, device=device)    # 全部用 1/z_number填充
         # z_alpha即为adaptive channel importance, 对于每一个Zn帮助他们适应不同的语义
         # z_alpha的每一个元素代表了feature map对应的channel的重要性
         return [z_estimate, z_alpha]
 
-    def cuda(self, device=None):
-        self.pggan.cuda(device=device)
+    def bind_layers(self, device=None, dtype=None):
+        self.pggan = get_gan_model(self.gan_model_name, device, dtype)
+        # generator被分成了两个子网络
+        # blending_layer即为论文中intermediate layer(中间层)
+        # 这样的划分是为了从任意给定的Zn中提取出相应的空间特征用于进一步的合成
+        self.pre_model = nn.Sequential(*list(self.pggan.children())[:self.blending_layer])
+        self.post_model = nn.Sequential(*list(self.pggan.children())[self.blending_layer:])
+        self.post_segments = split_by_resolution(self.post_model, self.checkpoint_blocks) \
+            if self.checkpoint_blocks > 0 else []
+
+    # 冻结latent codes: 每个code经过pre_model得到的feature map只与z_estimate有关, 缓存后只需要优化alpha
+    # 冻结期间forward不再使用z_estimate, 每次迭代只计算加权融合和post_model
+    # latent_estimate[1]为alpha, 其余的都是latent codes
+    def freeze_codes(self, latent_estimate):
+        z_estimate = latent_estimate[0]
+        with torch.no_grad():
+            batch_size = z_estimate.size()[0]
+            feature_maps = self.pre_model(z_estimate.detach().reshape((-1, self.z_dim, 1, 1)))
+            self.code_cache = feature_maps.view((batch_size, z_estimate.size()[1]) + feature_maps.size()[1:])
+
+    def unfreeze_codes(self):
+        self.code_cache = None
+
+    # 剪枝latent codes时同步更新缓存, keep_index为保留的codes的序号
+    def prune_codes(self, keep_index):
+        if self.code_cache is not None:
+            self.code_cache = self.code_cache[:, keep_index]
 
     def forward(self, z):
         z_estimate, alpha_estimate = z
+        if self.code_cache is not None:
+            weights = alpha_estimate.view(alpha_estimate.size()[:2] + (self.layer_c_number, 1, 1))
+            fused_feature_map = (self.code_cache * weights).sum(dim=1) / alpha_estimate.size()[1]
+            return self.post_forward(fused_feature_map)
         feature_maps_list = []
-        for j in range(self.z_number):
+        # codes的数量以输入为准, 剪枝后会小于self.z_number
+        z_number = z_estimate.size()[1]
+        for j in range(z_number):
             feature_maps_list.append(       # 从随机预计值生成feature maps并存入list
                 # torch矩阵 A * B 运算为逐位相乘, 对应论文第3页公式(2). 
                 # 使用alpha_estimate对feature map进行加权
                 self.pre_model(z_estimate[:, j, :].view((-1, self.z_dim, 1, 1))) * alpha_estimate[:, j, :].view((-1, self.layer_c_number, 1, 1)))
         # 每组latent code对应生成一个feature map, 使用多组latent codes来生成feature maps并融合结果
-        fused_feature_map = sum(feature_maps_list) / self.z_number      # 求所有feature maps的均值(feature maps按位求和再除以latent codes的数量)
+        fused_feature_map = sum(feature_maps_list) / z_number      # 求所有feature maps的均值(feature maps按位求和再除以latent codes的数量)
+        return self.post_forward(fused_feature_map)
+
+    def post_forward(self, fused_feature_map):
+        if self.post_segments and torch.is_grad_enabled():
+            y_estimate = fused_feature_map
+            for segment in self.post_segments:
+                y_estimate = checkpoint_segment(segment, y_estimate)
+            return y_estimate
         y_estimate = self.post_model(fused_feature_map)     # 从feature maps生成神经网络预计的图像(此时为tesnor, 需要转为image)
         return y_estimate
 
+
+# 共享字典模式: batch中的所有图片共用z_number个latent codes, 每次迭代只需对这些codes计算一次pre_model
+# 每张图片有自己的alpha(channel importance), 还可以有private_z_number个私有的codes
+# latent codes为[z_shared, alpha, z_private], 尺寸分别为
+# (1, z_number, z_dim), (batch_size, z_number + private_z_number, layer_c_number), (batch_size, private_z_number, z_dim)
+class PGGAN_multi_z_shared(PGGAN_multi_z):
+    can_prune_codes = False     # 共享的codes对batch中每张图片的重要性不同, 不支持剪枝
+
+    def __init__(self, gan_model_name, blending_layer, z_number, private_z_number, args):
+        if getattr(args, 'prune_every', 0) > 0:
+            raise ValueError('Pruning latent codes (`prune_every`) is not supported by the shared code dictionary!')
+        super(PGGAN_multi_z_shared, self).__init__(gan_model_name, blending_layer, z_number, args)
+        self.private_z_number = private_z_number
+
+    def input_size(self):
+        sizes = [(self.z_number, self.z_dim), (self.z_number + self.private_z_number, self.layer_c_number)]
+        if self.private_z_number > 0:
+            sizes.append((self.private_z_number, self.z_dim))
+        return sizes
+
+    def init_value(self, batch_size, device='cuda'):
+        code_number = self.z_number + self.private_z_number
+        z_shared = torch.randn((1, self.z_number, self.z_dim), device=device)
+        z_alpha = torch.full((batch_size, code_number, self.layer_c_number), 1 / code_number, device=device)
+        if self.private_z_number == 0:
+            return [z_shared, z_alpha]
+        z_private = torch.randn((batch_size, self.private_z_number, self.z_dim), device=device)
+        return [z_shared, z_alpha, z_private]
+
+    def code_feature_maps(self, z_estimate):
+        feature_maps = self.pre_model(z_estimate.reshape((-1, self.z_dim, 1, 1)))
+        return feature_maps.view(z_estimate.size()[:2] + feature_maps.size()[1:])
+
+    def freeze_codes(self, latent_estimate):
+        with torch.no_grad():
+            self.code_cache = [self.code_feature_maps(latent_estimate[0].detach())[0]]
+            if len(latent_estimate) > 2:
+                self.code_cache.append(self.code_feature_maps(latent_estimate[2].detach()))
+
+    def forward(self, z):
+        z_shared, alpha_estimate = z[0], z[1]
+        shared_number = z_shared.size()[1]
+        if self.code_cache is not None:
+            shared_maps = self.code_cache[0]
+            private_maps = self.code_cache[1] if len(self.code_cache) > 1 else None
+        else:
+            shared_maps = self.code_feature_maps(z_shared)[0]       # (z_number, c, h, w), 与batch大小无关
+            private_maps = self.code_feature_maps(z[2]) if len(z) > 2 else None
+        # 每张图片用自己的alpha对共享的feature maps加权求和
+        fused_feature_map = torch.einsum('nchw,bnc->bchw', shared_maps, alpha_estimate[:, :shared_number])
+        if private_maps is not None:
+            private_alpha = alpha_estimate[:, shared_number:]
+            fused_feature_map = fused_feature_map + \
+                (private_maps * private_alpha.view(private_alpha.size() + (1, 1))).sum(dim=1)
+        fused_feature_map = fused_feature_map / alpha_estimate.size()[1]
+        return self.post_forward(fused_feature_map)
+
+
+# 将生成器的层按分辨率分组, 每blocks_per_segment个分辨率组成一段
+# 带上采样的ConvBlock是一个新分辨率的开始
+def split_by_resolution(model, blocks_per_segment):
+    resolution_blocks = []
+    for layer in model.children():
+        upsample = getattr(layer, 'use_conv2d_transpose', False) or \
+            not isinstance(getattr(layer, 'upsample', nn.Identity()), nn.Identity)
+        if upsample or len(resolution_blocks) == 0:
+            resolution_blocks.append([])
+        resolution_blocks[-1].append(layer)
+    segments = []
+    for i in range(0, len(resolution_blocks), blocks_per_segment):
+        layers = sum(resolution_blocks[i:i + blocks_per_segment], [])
+        segments.append(nn.Sequential(*layers))
+    return segments
+
+
+# torch 1.11之后可以指定use_reentrant, 非reentrant的实现不要求输入带梯度, 且支持更多情况
+_CHECKPOINT_KWARGS = {'use_reentrant': False} \
+    if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (1, 11) else {}
+
+
+def checkpoint_segment(segment, x):
+    return checkpoint(segment, x, **_CHECKPOINT_KWARGS)
+
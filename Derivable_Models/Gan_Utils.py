@@ -9,14 +9,16 @@ import sys
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
 
 # 使用绝对路径
-from GAN.Model_Settings import MODEL_POOL
+from GAN.Model_Settings import MODEL_POOL, MAX_CACHED_GENERATOR_BYTES
 from GAN.pggan_generator import PGGANGenerator
 # from GAN.stylegan_generator import StyleGANGenerator
 # from GAN.stylegan2_generator import StyleGAN2Generator
+from GAN.pggan_generator_network import get_composing_layers
+from Derivable_Models.generator_registry import GeneratorRegistry
 
 
-PGGAN_Inter_Output_Layer_256 = [-1, 17, 14, 11, 8, 5, 2]
-PGGAN_Inter_Output_Layer_1024 = [-1, 23, 20, 17, 14, 11, 8, 5, 2]
+# 每个模型的拆分表, 按MODEL_POOL中的名称缓存
+_SPLIT_PLANS = {}
 
 # 生成器
 def build_generator(model_name, logger=None):
@@ -37,6 +39,10 @@ def build_generator(model_name, logger=None):
 
 
 
+# 进程内共享的生成器缓存, get_gan_model从这里取生成器
+GENERATOR_REGISTRY = GeneratorRegistry(build_generator, MAX_CACHED_GENERATOR_BYTES)
+
+
 def standard_z_sample(size, depth, device=None):
     '''
     Generate a standard set of random Z as a (size, z_dimension) tensor.
@@ -52,17 +58,47 @@ def standard_z_sample(size, depth, device=None):
     return result
 
 
-def get_gan_model(model_name):
+def get_split_plan(model_name, net=None):
+    """
+    Split table of a registered model, computed from the settings of the network and cached per model.
+    :param model_name: Please refer `MODEL_POOL`
+    :param net: the built network of the model. None for computing the layers from the settings of `MODEL_POOL`
+        (no network is built)
+    :return: dict with
+        'layer_names': names of the composing layers, the modules of the nn.Sequential of `get_gan_model`
+        'shapes': shapes[i] is the (channels, height, width) of the input of composing layer i,
+                  i.e. of the feature maps at composing layer i. shapes[-1] is the generated image.
+    """
+    if model_name not in _SPLIT_PLANS:
+        if not model_name in MODEL_POOL:
+            raise ValueError(f'Model `{model_name}` is not registered in '
+                             f'`MODEL_POOL` in `model_settings.py`!')
+        settings = MODEL_POOL[model_name]
+        if settings['gan_type'] != 'pggan':
+            raise NotImplementedError(f'Unsupported GAN type `{settings["gan_type"]}`!')
+        if net is not None:
+            layers = net.get_composing_layers()
+        else:
+            layers = get_composing_layers(settings['resolution'], settings.get('image_channels', 3))
+        _SPLIT_PLANS[model_name] = {
+            'layer_names': [name for name, _ in layers],
+            'shapes': [(settings['z_space_dim'], 1, 1)] + [shape for _, shape in layers],
+        }
+    return _SPLIT_PLANS[model_name]
+
+
+def get_gan_model(model_name, device=None, dtype=None):
     """
     :param model_name: Please refer `GAN_MODELS`
-    :return: gan_model(nn.Module or nn.Sequential)
+    :param device: device of the layers. None for the device the generator is built on
+    :param dtype: dtype of the layers. None for the dtype the generator is built with
+    :return: gan_model(nn.Module or nn.Sequential). The layers are shared through `GENERATOR_REGISTRY` and must
+        not be moved or converted in place, get the model again with another `device` / `dtype` instead
     """
-    gan = build_generator(model_name)
+    gan = GENERATOR_REGISTRY.get(model_name, device, dtype)     # 已加载过的模型直接共享权重
     if model_name.startswith('pggan'):
-        gan_list = list(gan.net.children())
-        remove_index = PGGAN_Inter_Output_Layer_1024 if model_name == 'pggan_celebahq' else PGGAN_Inter_Output_Layer_256
-        for output_index in remove_index:
-            gan_list.pop(output_index)    # 去除一些层
-        return nn.Sequential(*gan_list)   # *表示可以接收多个参数
+        # 按名称取出逐层合成的层, 去除中间分辨率的输出层
+        plan = get_split_plan(model_name, gan.net)
+        return nn.Sequential(*[getattr(gan.net, name) for name in plan['layer_names']])   # *表示可以接收多个参数
     elif model_name.startswith('style'):
         return gan
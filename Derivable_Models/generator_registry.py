@@ -0,0 +1,130 @@
+import copy
+import time
+from collections import OrderedDict
+
+import torch
+
+
+# 进程内的生成器缓存
+# 同一个模型只构建和加载一次权重, 所有的PGGAN/PGGAN_multi_z共享这份只读的权重
+# 按(模型, 设备, 精度)缓存, 其他设备或精度的副本从构建出的生成器复制得到
+# 缓存的模块被多个调用者共享, 不能原地修改(移动设备、转换精度、修改权重), 需要其他设备或精度时用get()取出对应的副本
+# 按最近使用顺序(LRU)淘汰, 使缓存的权重总大小不超过memory_budget
+class GeneratorRegistry(object):
+    def __init__(self, build_fn, memory_budget=None):
+        """
+        :param build_fn: function building the generator (e.g. `PGGANGenerator`) from the model name
+        :param memory_budget: max bytes of the cached weights. None for no limit.
+            The most recently used generator is always kept, even if it alone exceeds the budget.
+        """
+        self.build_fn = build_fn
+        self.memory_budget = memory_budget
+        self.generators = OrderedDict()     # (model_name, device, dtype) -> (generator, bytes), 最近使用的在最后
+        self.placements = {}        # model_name -> build_fn构建出的生成器的(device, dtype)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_times = {}        # 缓存项的名称 -> 最近一次加载的耗时(秒)
+
+    def get(self, model_name, device=None, dtype=None):
+        """
+        :param device: device of the weights. None for the device `build_fn` puts them on
+        :param dtype: dtype of the weights. None for the dtype `build_fn` gives them
+        :return: the cached generator of `model_name` on `device` with `dtype`, built and loaded on the first use.
+            The parameters are shared and read-only (requires_grad=False), the modules must not be changed.
+        """
+        key = self._key(model_name, device, dtype)
+        if key in self.generators:
+            self.hits += 1
+            self.generators.move_to_end(key)
+            return self.generators[key][0]
+        if key[1:] != (None, None):
+            base = self.get(model_name)     # 副本从构建出的生成器复制
+        self.misses += 1
+        start = time.perf_counter()
+        if key[1:] == (None, None):
+            generator = self.build_fn(model_name)
+            generator.net.requires_grad_(False)     # 反演只优化latent codes, 权重不需要梯度
+            self.placements[model_name] = placement(generator.net)
+        else:
+            generator = copy.copy(base)
+            generator.net = copy.deepcopy(base.net).to(device=key[1], dtype=key[2])
+            generator.run_device = str(key[1])
+        self.load_times[_label(key)] = time.perf_counter() - start
+        self.generators[key] = (generator, weight_bytes(generator.net))
+        self.shrink()
+        return generator
+
+    # 与构建出的生成器的设备和精度相同时使用(model_name, None, None)
+    def _key(self, model_name, device, dtype):
+        if device is None and dtype is None:
+            return model_name, None, None
+        if model_name not in self.placements:
+            self.get(model_name)
+        base_device, base_dtype = self.placements[model_name]
+        device = base_device if device is None else normalize_device(device)
+        dtype = base_dtype if dtype is None else dtype
+        if (device, dtype) == (base_device, base_dtype):
+            return model_name, None, None
+        return model_name, device, dtype
+
+    def shrink(self):
+        # 淘汰最久未使用的生成器, 直到满足内存上限
+        while self.memory_budget is not None and len(self.generators) > 1 \
+                and self.memory_used() > self.memory_budget:
+            self.generators.popitem(last=False)
+            self.evictions += 1
+
+    def evict(self, model_name=None):
+        """
+        Removes `model_name` (all models if None) from the cache, on every device and with every dtype.
+        Wrappers still holding the weights keep them alive until they are deleted.
+        """
+        keys = [key for key in self.generators if model_name is None or key[0] == model_name]
+        for key in keys:
+            del self.generators[key]
+        self.evictions += len(keys)
+
+    def memory_used(self):
+        return sum(size for _, size in self.generators.values())
+
+    def stats(self):
+        """
+        :return: dict of the cache statistics
+        """
+        return {'models': [_label(key) for key in self.generators],
+                'memory_used': self.memory_used(),
+                'memory_budget': self.memory_budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_seconds': dict(self.load_times)}
+
+
+def _label(key):
+    model_name, device, dtype = key
+    if device is None:
+        return model_name
+    return '%s@%s/%s' % (model_name, device, str(dtype).replace('torch.', ''))
+
+
+def normalize_device(device):
+    # 'cuda'与'cuda:0'是同一个设备
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+def placement(net):
+    """
+    :return: (device, dtype) of the floating point weights of `net`
+    """
+    for t in list(net.parameters()) + list(net.buffers()):
+        if t.is_floating_point():
+            return t.device, t.dtype
+    return torch.device('cpu'), torch.get_default_dtype()
+
+
+def weight_bytes(net):
+    return sum(t.numel() * t.element_size() for t in list(net.parameters()) + list(net.buffers()))
@@ -19,9 +19,6 @@ MODEL_DIR = os.path.join(BASE_DIR, 'pretrain')
 PTH_MODEL_DIR = 'pytorch'
 TF_MODEL_DIR = 'tensorflow'
 
-if not os.path.exists(os.path.join(MODEL_DIR, PTH_MODEL_DIR)):
-  os.makedirs(os.path.join(MODEL_DIR, PTH_MODEL_DIR))
-
 # pylint: disable=line-too-long
 MODEL_POOL = {
     # PGGAN Official.
@@ -336,12 +333,47 @@ MODEL_POOL = {
         'fused_scale': False,
     },
 }
+
+# 固件模型: 每个支持的分辨率一个, 使用固定随机种子(模型名的crc32)生成的N(0,1)权重, 不需要下载任何文件
+# 本地存在weight_path时仍然优先加载本地权重
+for _res in [8, 16, 32, 64, 128, 256, 512, 1024]:
+  MODEL_POOL[f'pggan_fixture{_res}'] = {
+      'weight_path': os.path.join(MODEL_DIR, PTH_MODEL_DIR, f'pggan_fixture{_res}_generator.pth'),
+      'gan_type': 'pggan',
+      'dataset_name': 'fixture',
+      'z_space_dim': 512,
+      'resolution': _res,
+      'fused_scale': False,
+      'fixture': True,
+  }
 # pylint: enable=line-too-long
 
 # Settings for model running.
 # 默认使用GPU
 USE_CUDA = True
 
+# 一次在设备上处理的图片数量. 设为None时用`memory_probe.py`测量每张图片的峰值内存, 按内存预算自动选择
 MAX_IMAGES_ON_DEVICE = 8
 
 MAX_IMAGES_ON_RAM = 1600
+
+# `easy_synthesize()`在计算设备上后处理图片, 只拷贝uint8的结果. 默认关闭, 在numpy中后处理
+POSTPROCESS_ON_DEVICE = False
+
+# 流水线合成: 下一个batch的前向传播与当前batch的拷贝(固定内存, 异步)和后处理重叠. 默认关闭, 逐个batch运行
+PIPELINED_SYNTHESIS = False
+
+# 固件模式: 没有预训练权重的模型(以及VGG16)使用固定随机种子的权重, 可以完全离线运行
+# 也可以通过环境变量`MGAN_FIXTURE_MODE=1`打开
+FIXTURE_MODE = os.environ.get('MGAN_FIXTURE_MODE', '0') == '1'
+
+# 进程内缓存的生成器占用内存的上限(字节), 超出后按LRU淘汰. None表示不限制
+MAX_CACHED_GENERATOR_BYTES = 2 << 30
+
+# 自动选择batch大小时的内存预算(字节). None表示设备当前可用内存 * MEMORY_SAFETY
+MEMORY_BUDGET = None
+
+MEMORY_SAFETY = 0.8
+
+# 每台机器、设备和配置测量的峰值内存的缓存
+MEMORY_PROBE_CACHE = os.path.join(MODEL_DIR, 'memory_probe.json')
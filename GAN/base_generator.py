@@ -4,6 +4,9 @@
 import os.path
 import sys
 import logging
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 import torch
@@ -12,9 +15,11 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
 
 # 使用绝对路径
 import GAN.Model_Settings as Model_Settings
+from GAN.flat_weights import flat_weight_path, bind_flat
+from GAN.memory_probe import synthesis_batch_size
 
 # 对外接口 
-__all__ = ['BaseGenerator']
+__all__ = ['BaseGenerator', 'postprocess_tensor']
 
 
 # 日志
@@ -47,6 +52,49 @@ def get_temp_logger(logger_name='logger'):
   return logger
 
 
+# 在计算设备上完成后处理, 只把uint8的结果拷贝到内存 (数据量为float32的四分之一)
+def postprocess_tensor(images, min_val=-1.0, max_val=1.0, channel_order='RGB',
+                       to_host=True):
+  """Postprocesses the raw output tensor on its device.
+
+  Does the same as `BaseGenerator.postprocess()`: maps `[min_val, max_val]` to
+  `[0, 255]`, rounds, clamps and permutes to [batch_size, height, width,
+  channel] with `RGB` order, but on the device of `images`, and only copies the
+  `uint8` result to host.
+
+  Args:
+    images: `torch.Tensor` with shape [batch_size, channel, height, width].
+    min_val: Minimum value of the raw synthesis. (default: -1.0)
+    max_val: Maximum value of the raw synthesis. (default: 1.0)
+    channel_order: Channel order of the raw synthesis. (default: `RGB`)
+    to_host: Whether to copy the result to host. (default: True)
+
+  Returns:
+    The postprocessed images as `numpy.ndarray` with dtype `numpy.uint8`, or
+      the contiguous `uint8` tensor on the device if `to_host` is False.
+
+  Raises:
+    ValueError: If the input `images` are not with type `torch.Tensor` or not
+      with shape [batch_size, channel, height, width].
+  """
+  if not isinstance(images, torch.Tensor):
+    raise ValueError(f'Images should be with type `torch.Tensor`!')
+  if images.dim() != 4 or images.shape[1] not in [1, 3]:
+    raise ValueError(f'Input should be with shape [batch_size, channel, '
+                     f'height, width], where channel equals to 1 or 3!\n'
+                     f'But {tuple(images.shape)} is received!')
+
+  with torch.no_grad():
+    # 第一步生成新的张量, 之后的操作都是原地操作, 不再分配float张量
+    images = images.float() - min_val
+    images.mul_(255 / (max_val - min_val)).add_(0.5).clamp_(0, 255)
+    images = images.to(torch.uint8).permute(0, 2, 3, 1)
+    if images.shape[3] == 3 and channel_order == 'BGR':  # 将'BGR'转为'RGB'
+      images = images.flip(3)
+    images = images.contiguous()
+  return images.cpu().numpy() if to_host else images
+
+
 class BaseGenerator(object):
   """Base class for generator used in GAN variants."""
 
@@ -83,8 +131,13 @@ class BaseGenerator(object):
       # 读取Model_Settings里面对应model的所有参数
       setattr(self, key, val)
     self.use_cuda = Model_Settings.USE_CUDA and torch.cuda.is_available() # 是否使用GPU
-    self.batch_size = Model_Settings.MAX_IMAGES_ON_DEVICE   # batch大小, 一次处理的数量
+    self._batch_size = Model_Settings.MAX_IMAGES_ON_DEVICE   # batch大小, 一次处理的数量. None表示首次使用时自动选择
     self.ram_size = Model_Settings.MAX_IMAGES_ON_RAM  # 内存最大阈值
+    self.postprocess_on_device = Model_Settings.POSTPROCESS_ON_DEVICE   # 在设备上转换为uint8之后再拷贝
+    self.pipelined = Model_Settings.PIPELINED_SYNTHESIS   # 下一个batch的前向传播与当前batch的拷贝和后处理重叠
+    self._executor = None     # 流水线的后处理线程池
+    self._pinned_buffers = []   # 流水线的固定内存缓冲区, 在多次运行之间复用
+    self._copy_streams = {}     # 流水线拷贝到host使用的cuda stream, 每个设备一个
     self.net = None
     self.run_device = 'cuda' if self.use_cuda else 'cpu'    
     self.cpu_device = 'cpu'
@@ -93,6 +146,10 @@ class BaseGenerator(object):
     # getattr(object, name[, default])
     self.weight_path = getattr(self, 'weight_path', '')
     self.tf_weight_path = getattr(self, 'tf_weight_path', '')
+    self.fixture = getattr(self, 'fixture', False)
+    self.flat_weight_path = getattr(
+        self, 'flat_weight_path',
+        flat_weight_path(self.weight_path) if self.weight_path else '')
     self.check_attr('gan_type')
     self.check_attr('z_space_dim')
     self.check_attr('resolution')
@@ -107,12 +164,17 @@ class BaseGenerator(object):
     self.logger.info(f'Build generator for model `{self.model_name}`.')
     self.model_specific_vars = []
     self.build()    # Base类不能被实例化, 需要由子类继承并复写
-    # 加载pytorch预训练好的模型
-    if os.path.isfile(self.weight_path):
+    # 优先映射flat权重(不拷贝), 其次加载pytorch预训练好的模型
+    if self.flat_weights_current():
+      self.load_flat()
+    elif os.path.isfile(self.weight_path):
       self.load()
     # 加载Tensorflow预训练好的模型并转化为pytorch张量 (需要复写)
     elif os.path.isfile(self.tf_weight_path):
       self.convert_tf_weights()
+    # 固件模型, 或者在固件模式下, 使用固定随机种子的权重
+    elif self.fixture or Model_Settings.FIXTURE_MODE:
+      self.init_fixture_weights()
     else:
       self.logger.warning(f'No pre-trained weights will be loaded!')
 
@@ -120,6 +182,22 @@ class BaseGenerator(object):
     assert self.net
     self.net.eval().to(self.run_device)
 
+  @property
+  def batch_size(self):
+    """Number of images synthesized at a time on the device.
+
+    If `Model_Settings.MAX_IMAGES_ON_DEVICE` is `None`, the largest batch size
+    fitting into the memory budget is measured by `memory_probe.py` the first
+    time it is used.
+    """
+    if self._batch_size is None:
+      self._batch_size = synthesis_batch_size(self, max_batch_size=self.ram_size)
+    return self._batch_size
+
+  @batch_size.setter
+  def batch_size(self, batch_size):
+    self._batch_size = batch_size
+
   # 检查参数是否存在
   def check_attr(self, attr_name):
     """Checks the existence of a particular attribute.
@@ -149,6 +227,35 @@ class BaseGenerator(object):
     self.net.load_state_dict(state_dict)
     self.logger.info(f'Successfully loaded!')
 
+  # flat权重存在且不比pytorch权重旧时才使用
+  def flat_weights_current(self):
+    """Checks whether the flat weights exist and are up to date."""
+    if not self.flat_weight_path or not os.path.isfile(self.flat_weight_path):
+      return False
+    return (not os.path.isfile(self.weight_path) or
+            os.path.getmtime(self.flat_weight_path) >=
+            os.path.getmtime(self.weight_path))
+
+  # 将flat权重映射到内存并直接绑定到网络参数, 多个进程共享同一份page cache
+  def load_flat(self):
+    """Loads pre-trained weights by memory-mapping the flat weights."""
+    self.logger.info(f'Mapping flat weights from `{self.flat_weight_path}`.')
+    bind_flat(self.net, self.flat_weight_path, self.model_specific_vars)
+    self.logger.info(f'Successfully loaded!')
+
+  # 按模型名称生成确定的随机权重, 相同名称在任何机器上得到相同的权重
+  def init_fixture_weights(self):
+    """Initializes the weights with N(0, 1), seeded by the CRC32 of the model name.
+
+    Scalar parameters (e.g. `lod`) are kept.
+    """
+    self.logger.info(f'Initializing fixture weights of `{self.model_name}`.')
+    generator = torch.Generator().manual_seed(zlib.crc32(self.model_name.encode('utf-8')))
+    with torch.no_grad():
+      for param in self.net.parameters():
+        if param.dim() > 0:
+          param.copy_(torch.randn(param.shape, generator=generator))
+
   # 如果是tensorflow模型,则加载之后转化为pytorch
   # 需要被复写
   def convert_tf_weights(self, test_num=10):
@@ -200,12 +307,123 @@ class BaseGenerator(object):
       # 一次返回batch_size个inputs
       yield inputs[i:i + batch_size]    # yield是一个生成器,有些类似于return, 在下次调用next()的时候返回上一次返回的地方继续执行
 
-  # 分批输入运行, 最后组合输出结果
-  def batch_run(self, inputs, run_fn):
+  # 分批输入运行, 逐个返回每个batch的输出
+  def batch_iter(self, inputs, run_fn):
+    """Runs model with mini-batch and yields the outputs batch by batch.
+
+    Only one mini-batch of outputs is kept in memory at a time, so this can be
+    used for runs whose outputs do not fit into memory.
+
+    Args:
+      inputs: The input samples to run with.
+      run_fn: A callable function.
+
+    Yields:
+      The output of `run_fn` on every mini-batch.
+
+    Raises:
+      ValueError: If the output type of `run_fn` is not supported.
+    """
+    for batch_inputs in self.get_batch_inputs(inputs):
+      yield self._check_outputs(run_fn(batch_inputs))
+
+  # 运行结果只能是ndarray或者ndarray的字典
+  def _check_outputs(self, batch_outputs):
+    # 如果是字典, 每一项都需要是ndarray
+    if isinstance(batch_outputs, dict):
+      for key, val in batch_outputs.items():
+        if not isinstance(val, np.ndarray):
+          raise ValueError(f'Each item of the model output should be with '
+                           f'type `numpy.ndarray`, but type `{type(val)}` is '
+                           f'received for key `{key}`!')
+    elif not isinstance(batch_outputs, np.ndarray):
+      raise ValueError(f'The model output can only be with type '
+                       f'`numpy.ndarray`, or a dictionary of '
+                       f'`numpy.ndarray`, but type `{type(batch_outputs)}` '
+                       f'is received!')
+    return batch_outputs
+
+  # 流水线分批运行: 设备上的前向传播与拷贝、后处理重叠
+  def pipeline_iter(self, inputs, forward_fn, host_fn, depth=2):
+    """Runs model with mini-batch in a pipeline and yields the outputs in order.
+
+    `forward_fn(batch_inputs)` runs on the calling thread and returns a
+    `torch.Tensor`. The tensor is copied to host and
+    `host_fn(batch_inputs, array)` runs on a worker thread, so the copy and the
+    host work (e.g. postprocessing and encoding) of batch i overlap with the
+    forward of batch i + 1. At most `depth` batches are in flight.
+
+    On cuda, the copies are issued on a dedicated copy stream, so they overlap
+    with the forward of the next batch on the compute stream, and go through
+    `depth` pinned host buffers. The buffers are reused across batches and
+    runs, so `array` is only valid during `host_fn`, which must copy what it
+    keeps.
+
+    Args:
+      inputs: The input samples to run with.
+      forward_fn: Callable returning the device output of a mini-batch.
+      host_fn: Callable returning the outputs of a mini-batch, with the same
+        types as `run_fn` of `batch_run()`.
+      depth: Number of batches in flight. (default: 2)
+
+    Yields:
+      The output of `host_fn` on every mini-batch.
+    """
+    if self._executor is None:
+      self._executor = ThreadPoolExecutor(max_workers=depth)
+    if len(self._pinned_buffers) < depth:
+      self._pinned_buffers += [None] * (depth - len(self._pinned_buffers))
+
+    pending = deque()
+    for i, batch_inputs in enumerate(self.get_batch_inputs(inputs)):
+      output = forward_fn(batch_inputs)
+      # 缓冲区上一次被batch i - depth使用, 先等待它处理完成
+      if len(pending) >= depth:
+        yield self._check_outputs(pending.popleft().result())
+      if output.is_cuda:
+        slot = i % depth
+        buffer = self._pinned_buffers[slot]
+        if (buffer is None or buffer.dtype != output.dtype or
+            buffer.numel() < output.numel()):
+          buffer = torch.empty(output.numel(), dtype=output.dtype,
+                               pin_memory=True)
+          self._pinned_buffers[slot] = buffer
+        host = buffer[:output.numel()].view(output.shape)
+        # 在单独的stream上拷贝, 不与下一个batch的前向传播串行
+        # 拷贝要等待计算output的运算完成; output在拷贝完成之前不能被分配器复用
+        copy_stream = self._copy_stream(output.device)
+        copy_stream.wait_stream(torch.cuda.current_stream(output.device))
+        with torch.cuda.stream(copy_stream):
+          host.copy_(output, non_blocking=True)
+          copied = torch.cuda.Event()
+          copied.record(copy_stream)
+        output.record_stream(copy_stream)
+        pending.append(self._executor.submit(
+            self._host_after_copy, host_fn, batch_inputs, host, copied))
+      else:
+        pending.append(self._executor.submit(
+            host_fn, batch_inputs, output.detach().numpy()))
+    while pending:
+      yield self._check_outputs(pending.popleft().result())
+
+  def _copy_stream(self, device):
+    if device not in self._copy_streams:
+      self._copy_streams[device] = torch.cuda.Stream(device)
+    return self._copy_streams[device]
+
+  # 缓冲区在batch i + depth复用之前, pipeline_iter会先等待这里返回(即拷贝完成)
+  @staticmethod
+  def _host_after_copy(host_fn, batch_inputs, host, copied):
+    copied.synchronize()    # 只等待这一次拷贝, 不阻塞设备上后续的运算
+    return host_fn(batch_inputs, host.numpy())
+
+  # 分批输入运行, 输出直接写入预先分配的数组
+  def batch_run(self, inputs, run_fn, output_path=None):
     """Runs model with mini-batch.
 
     This function splits the inputs into mini-batches, run the model with each
-    mini-batch, and then concatenate the outputs from all mini-batches together.
+    mini-batch, and writes the outputs into arrays allocated from the shape and
+    dtype of the first mini-batch, so no second copy of the outputs is made.
 
     NOTE: The output of `run_fn` can only be `numpy.ndarray` or a dictionary
     whose values are all `numpy.ndarray`.
@@ -213,52 +431,58 @@ class BaseGenerator(object):
     Args:
       inputs: The input samples to run with.
       run_fn: A callable function.
+      output_path: If set, the outputs are written to memory-mapped `.npy`
+        files instead of memory, `{output_path}.npy` for an array output and
+        `{output_path}_{key}.npy` for a dictionary output. (default: None)
 
     Returns:
-      Same type as the output of `run_fn`.
+      Same type as the output of `run_fn`, with `numpy.memmap` values if
+        `output_path` is set.
 
     Raises:
       ValueError: If the output type of `run_fn` is not supported.
     """
-    
-    if inputs.shape[0] > self.ram_size:
+    return self.collect_outputs(self.batch_iter(inputs, run_fn),
+                                inputs.shape[0], output_path)
+
+  # 将逐个batch的输出写入预先分配的数组
+  def collect_outputs(self, batch_outputs_iter, total_num, output_path=None):
+    """Collects the outputs yielded batch by batch, see `batch_run()`."""
+    if output_path is None and total_num > self.ram_size:
       self.logger.warning(f'Number of inputs on RAM is larger than '
-          f'{self.ram_size}. Please use '
-          f'`self.get_batch_inputs()` to split the inputs! '
+          f'{self.ram_size}. Please use `output_path` or '
+          f'`self.batch_iter()` to keep the outputs out of memory! '
           f'Otherwise, it may encounter OOM problem!')
 
-    results = {}  # 将结果保存为ndarray字典
+    if output_path is not None:
+      os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
     temp_key = '__temp_key__'
-    for batch_inputs in self.get_batch_inputs(inputs):
-      batch_outputs = run_fn(batch_inputs)
-      # 如果是字典
-      if isinstance(batch_outputs, dict):
+    results = None
+    index = 0
+    for batch_outputs in batch_outputs_iter:
+      if not isinstance(batch_outputs, dict):
+        batch_outputs = {temp_key: batch_outputs}
+      # 根据第一个batch的形状和类型分配全部输出
+      if results is None:
+        results = {}
         for key, val in batch_outputs.items():
-          # 如果不是ndarray类型则抛出异常
-          if not isinstance(val, np.ndarray):
-            raise ValueError(f'Each item of the model output should be with '
-                             f'type `numpy.ndarray`, but type `{type(val)}` is '
-                             f'received for key `{key}`!')
-          if key not in results:
-            results[key] = [val]
+          shape = (total_num,) + val.shape[1:]
+          if output_path is None:
+            results[key] = np.empty(shape, dtype=val.dtype)
           else:
-            results[key].append(val)
-      # 如果是ndarray 
-      elif isinstance(batch_outputs, np.ndarray):
-        if temp_key not in results:
-          results[temp_key] = [batch_outputs]
-        else:
-          results[temp_key].append(batch_outputs)
-      else:
-        raise ValueError(f'The model output can only be with type '
-                         f'`numpy.ndarray`, or a dictionary of '
-                         f'`numpy.ndarray`, but type `{type(batch_outputs)}` '
-                         f'is received!')
-
-    for key, val in results.items():
-      # concatenate((a1, a2, …), axis=0) 数组拼接, 默认axis=0即同轴向拼接
-      # 由于val可能是由之前append产生的ndarray的数组,所以这里将数组中的所有ndarray拼接到一起
-      results[key] = np.concatenate(val, axis=0)
+            path = output_path if key == temp_key else f'{output_path}_{key}'
+            results[key] = np.lib.format.open_memmap(
+                path + '.npy', mode='w+', dtype=val.dtype, shape=shape)
+      batch_num = next(iter(batch_outputs.values())).shape[0]
+      for key, val in batch_outputs.items():
+        results[key][index:index + batch_num] = val
+      index += batch_num
+
+    if results is None:   # 没有输入
+      return {}
+    if output_path is not None:
+      for val in results.values():
+        val.flush()
     return results if temp_key not in results else results[temp_key]
 
   # 随机生成样本latent codes, 需子类复写
@@ -302,6 +526,8 @@ class BaseGenerator(object):
 
     Args:
       latent_codes: Input latent codes for image synthesis.
+      postprocess: Whether to return the images postprocessed on the device
+        (see `postprocess_tensor()`) instead of the raw outputs.
 
     Returns:
       A dictionary whose values are raw outputs from the generator. Keys of the
@@ -362,10 +588,39 @@ class BaseGenerator(object):
 
     return images
 
-  # 打包上述两个方法
-  def easy_synthesize(self, latent_codes, **kwargs):
-    """Wraps functions `synthesize()` and `postprocess()` together."""
+  # 单个batch合成并后处理
+  def _easy_synthesize(self, latent_codes, **kwargs):
+    if self.postprocess_on_device:
+      return self.synthesize(latent_codes, postprocess=True, **kwargs)
     outputs = self.synthesize(latent_codes, **kwargs)
     if 'image' in outputs:
       outputs['image'] = self.postprocess(outputs['image'])
     return outputs
+
+  # 在设备上后处理
+  def postprocess_tensor(self, images, to_host=True):
+    """Same as `postprocess()` but runs on the device of the `torch.Tensor`."""
+    assert images.shape[1] == self.image_channels
+    return postprocess_tensor(images, self.min_val, self.max_val,
+                              self.channel_order, to_host)
+
+  # 打包上述两个方法
+  def easy_synthesize(self, latent_codes, output_path=None, **kwargs):
+    """Wraps functions `synthesize()` and `postprocess()` together.
+
+    Every mini-batch is postprocessed right after the synthesis, so only the
+    `uint8` images of all the inputs are kept. See `batch_run()` for
+    `output_path`.
+    """
+    if self.postprocess_on_device:    # 由synthesize()分批(或者流水线)运行并后处理
+      return self.synthesize(latent_codes, output_path=output_path,
+                             postprocess=True, **kwargs)
+    return self.batch_run(latent_codes,
+                          lambda batch: self._easy_synthesize(batch, **kwargs),
+                          output_path=output_path)
+
+  # 逐个batch返回后处理的结果, 内存占用与输入数量无关
+  def iter_easy_synthesize(self, latent_codes, **kwargs):
+    """Same as `easy_synthesize()` but yields the outputs batch by batch."""
+    return self.batch_iter(latent_codes,
+                           lambda batch: self._easy_synthesize(batch, **kwargs))
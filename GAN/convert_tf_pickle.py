@@ -0,0 +1,136 @@
+# python 3.7
+"""Converts the official PGGAN pickles to pytorch weights without tensorflow.
+
+The official `karras2018iclr-*.pkl` files store `(G, D, Gs)` as pickled
+`tfutil.Network` objects, whose state already holds the variables as numpy
+arrays. Unpickling them with a stub `Network` class (in the same way as
+`legacy.LegacyUnpickler` remaps the old classes) gives the variables without
+building any tensorflow graph.
+
+  python GAN/convert_tf_pickle.py                     # every model in `MODEL_POOL`
+  python GAN/convert_tf_pickle.py --models pggan_bedroom,pggan_celebahq --flat
+"""
+
+import argparse
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+# 使用绝对路径
+from GAN.Model_Settings import MODEL_POOL
+from GAN.pggan_generator import convert_tf_variables
+from GAN.pggan_generator_network import PGGANGeneratorNet
+from GAN.flat_weights import flat_weight_path, save_flat
+
+__all__ = ['load_tf_variables', 'convert_model']
+
+
+# 代替tfutil.Network, 只保存pickle中的状态
+class StubNetwork(object):
+  """Stub of `tfutil.Network`, which keeps the pickled state only."""
+
+  def __setstate__(self, state):
+    if state.get('version') != 2:
+      raise ValueError(f'Only the tensorflow networks (version 2) are supported, '
+                       f'but version `{state.get("version")}` received!')
+    self.state = state
+
+  def __getstate__(self):
+    return self.state
+
+
+class StubUnpickler(pickle.Unpickler):
+  """Unpickler mapping `tfutil.Network` (and the legacy one) to `StubNetwork`."""
+
+  def find_class(self, module, name):
+    if name == 'Network' and module in ['tfutil', 'network']:
+      return StubNetwork
+    return super().find_class(module, name)
+
+
+def load_tf_variables(tf_weight_path):
+  """Loads the variables of the generator `Gs` from an official pickle.
+
+  Returns:
+    Dictionary from tensorflow variable name to `numpy.ndarray`.
+  """
+  with open(tf_weight_path, 'rb') as f:
+    _, _, tf_net = StubUnpickler(f).load()  # G, D, Gs
+  return dict(tf_net.__getstate__()['variables'])
+
+
+# 输出已存在且不比pickle旧则跳过
+def _up_to_date(output_path, input_path):
+  return (os.path.isfile(output_path) and
+          os.path.getmtime(output_path) >= os.path.getmtime(input_path))
+
+
+def convert_model(model_name, flat=False, force=False):
+  """Converts the tensorflow weights of `model_name` in `MODEL_POOL`.
+
+  Args:
+    model_name: Name of the model.
+    flat: Whether to write the flat weights as well. (default: False)
+    force: Whether to convert even if the outputs are up to date.
+      (default: False)
+
+  Returns:
+    A message of the result.
+  """
+  settings = MODEL_POOL[model_name]
+  tf_weight_path = settings.get('tf_weight_path', '')
+  weight_path = settings['weight_path']
+  if settings['gan_type'] != 'pggan':
+    return f'Skip `{model_name}`: unsupported GAN type `{settings["gan_type"]}`.'
+  if not os.path.isfile(tf_weight_path):
+    return f'Skip `{model_name}`: `{tf_weight_path}` does not exist.'
+  outputs = [weight_path] + ([flat_weight_path(weight_path)] if flat else [])
+  if not force and all(_up_to_date(path, tf_weight_path) for path in outputs):
+    return f'Skip `{model_name}`: up to date.'
+
+  start = time.time()
+  net = PGGANGeneratorNet(resolution=settings['resolution'],
+                          z_space_dim=settings['z_space_dim'],
+                          image_channels=settings.get('image_channels', 3),
+                          fused_scale=settings['fused_scale'])
+  state_dict = convert_tf_variables(load_tf_variables(tf_weight_path), net)
+  os.makedirs(os.path.dirname(weight_path), exist_ok=True)
+  torch.save(state_dict, weight_path)
+  if flat:
+    save_flat(state_dict, flat_weight_path(weight_path))
+  return f'Converted `{model_name}` in {time.time() - start:.1f}s.'
+
+
+def main(args):
+  model_names = args.models.split(',') if args.models else \
+      [name for name, settings in MODEL_POOL.items()
+       if settings['gan_type'] == 'pggan' and not settings.get('fixture', False)]
+  workers = args.workers or os.cpu_count() or 1
+  # 每个模型在单独的进程中转换
+  with ProcessPoolExecutor(max_workers=min(workers, len(model_names))) as executor:
+    futures = [executor.submit(convert_model, name, args.flat, args.force)
+               for name in model_names]
+    for future in futures:
+      print(future.result())
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Convert the official PGGAN pickles without tensorflow.')
+  parser.add_argument('--models', default='',
+                      help='Comma separated models in `MODEL_POOL`. Empty for all PGGAN models.')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='Number of processes. 0 for the number of cpus.')
+  parser.add_argument('--flat', action='store_true',
+                      help='Write the flat weights (see `flat_weights.py`) as well.')
+  parser.add_argument('--force', action='store_true',
+                      help='Convert even if the outputs are up to date.')
+
+  args, other_args = parser.parse_known_args()
+  main(args)
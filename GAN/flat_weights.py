@@ -0,0 +1,184 @@
+# python 3.7
+"""Flat weight format which can be memory-mapped and used without copying.
+
+Layout of a `.flat` file:
+
+  MAGIC (8 bytes) | header length (uint64, little endian) | JSON header |
+  padding | tensor data, every tensor starting at a 64-byte aligned offset
+
+The JSON header records the `dtype`, `shape` and absolute `offset` of every
+tensor. Loading maps the file with `np.memmap` in copy-on-write mode and binds
+the tensors to the network parameters directly, so several processes share one
+page-cached copy of the weights and nothing is read until it is touched.
+
+Convert the existing pytorch weights with:
+
+  python GAN/flat_weights.py                      # every model in `MODEL_POOL`
+  python GAN/flat_weights.py --models pggan_celebahq
+  python GAN/flat_weights.py --input a.pth --output a.flat
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+__all__ = ['flat_weight_path', 'save_flat', 'load_flat', 'bind_flat']
+
+MAGIC = b'MGANFLAT'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(offset):
+  return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# 由pytorch权重路径得到对应的flat权重路径
+def flat_weight_path(weight_path):
+  """Gets the path of the flat weights converted from `weight_path`."""
+  return os.path.splitext(weight_path)[0] + '.flat'
+
+
+def save_flat(state_dict, path):
+  """Saves a state dict in the flat format.
+
+  Args:
+    state_dict: Dictionary from name to `torch.Tensor`.
+    path: Path to save the weights. The file is written to a temporary file
+      first and then renamed, so readers never see a partial file.
+  """
+  arrays = {name: tensor.detach().cpu().contiguous().numpy()
+            for name, tensor in state_dict.items()}
+  # 头部长度依赖于偏移量, 先预留足够大的头部(每个偏移量最多20位数字), 剩余部分用空格补齐
+  header = {'version': VERSION, 'tensors': {}}
+  for name, array in arrays.items():
+    header['tensors'][name] = {'dtype': array.dtype.str,
+                               'shape': list(array.shape),
+                               'offset': 0}
+  header_size = _align(len(MAGIC) + 8 + len(json.dumps(header)) +
+                       len(arrays) * 20 + ALIGNMENT)
+  offset = header_size
+  for name, array in arrays.items():
+    header['tensors'][name]['offset'] = offset
+    offset = _align(offset + array.nbytes)
+  header_bytes = json.dumps(header).encode('utf-8')
+  header_bytes += b' ' * (header_size - len(MAGIC) - 8 - len(header_bytes))
+
+  temp_path = path + '.tmp'
+  with open(temp_path, 'wb') as f:
+    f.write(MAGIC)
+    f.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+    f.write(header_bytes)
+    for name, array in arrays.items():
+      f.seek(header['tensors'][name]['offset'])
+      f.write(array.tobytes())
+    f.truncate(offset)
+  os.replace(temp_path, path)
+
+
+def load_flat(path):
+  """Maps the flat weights into memory.
+
+  Args:
+    path: Path of the flat weights.
+
+  Returns:
+    A dictionary from name to `torch.Tensor`, which shares the memory of the
+      mapped file. The mapping is copy-on-write: writing a tensor never changes
+      the file.
+
+  Raises:
+    ValueError: If the file is not in the flat format.
+  """
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f'`{path}` is not a flat weight file!')
+    header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+    header = json.loads(f.read(header_length).decode('utf-8'))
+  if header.get('version') != VERSION:
+    raise ValueError(f'Unsupported flat weight version `{header.get("version")}` '
+                     f'of `{path}`!')
+  data = np.memmap(path, dtype=np.uint8, mode='c')
+  tensors = {}
+  for name, info in header['tensors'].items():
+    dtype = np.dtype(info['dtype'])
+    count = int(np.prod(info['shape'], dtype=np.int64))
+    array = data[info['offset']:info['offset'] + count * dtype.itemsize]
+    tensors[name] = torch.from_numpy(array.view(dtype).reshape(info['shape']))
+  return tensors
+
+
+def bind_flat(net, path, skip_vars=()):
+  """Binds the flat weights to the parameters and buffers of `net` in place.
+
+  The parameters are replaced by the mapped tensors instead of being copied.
+
+  Args:
+    net: The `nn.Module` to load.
+    path: Path of the flat weights.
+    skip_vars: Names of the variables kept as they are (model specific ones).
+
+  Raises:
+    ValueError: If a variable is missing or has a different shape.
+  """
+  tensors = load_flat(path)
+  for module_name, module in net.named_modules():
+    prefix = f'{module_name}.' if module_name else ''
+    for store in [module._parameters, module._buffers]:  # pylint: disable=protected-access
+      for var_name, var in store.items():
+        name = prefix + var_name
+        if var is None or name in skip_vars:
+          continue
+        if name not in tensors:
+          raise ValueError(f'Variable `{name}` is missing in `{path}`!')
+        if tuple(tensors[name].shape) != tuple(var.shape):
+          raise ValueError(f'Shape of `{name}` in `{path}` is '
+                           f'{tuple(tensors[name].shape)}, but '
+                           f'{tuple(var.shape)} is expected!')
+        var.data = tensors[name]
+
+
+# 将pytorch权重(.pth)转换为flat权重
+def convert(input_path, output_path):
+  """Converts pytorch weights saved by `torch.save` to the flat format."""
+  state_dict = torch.load(input_path, map_location='cpu')
+  save_flat(state_dict, output_path)
+  return output_path
+
+
+def main(args):
+  if args.input:
+    output_path = args.output or flat_weight_path(args.input)
+    print(f'Converting `{args.input}` to `{output_path}`.')
+    convert(args.input, output_path)
+    return
+  from GAN.Model_Settings import MODEL_POOL
+  model_names = args.models.split(',') if args.models else list(MODEL_POOL)
+  for model_name in model_names:
+    weight_path = MODEL_POOL[model_name].get('weight_path', '')
+    if not os.path.isfile(weight_path):
+      print(f'Skip `{model_name}`: `{weight_path}` does not exist.')
+      continue
+    output_path = flat_weight_path(weight_path)
+    print(f'Converting `{weight_path}` to `{output_path}`.')
+    convert(weight_path, output_path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert pytorch weights to the flat format.')
+  parser.add_argument('--models', default='',
+                      help='Comma separated models in `MODEL_POOL` to convert. '
+                           'Empty for all models with pytorch weights.')
+  parser.add_argument('--input', default='', help='A single `.pth` file to convert.')
+  parser.add_argument('--output', default='',
+                      help='Output of `--input`. Empty for the same name with `.flat`.')
+
+  args, other_args = parser.parse_known_args()
+  main(args)
@@ -0,0 +1,296 @@
+# python 3.7
+"""Measures the peak memory per sample and picks an OOM-safe batch size.
+
+The peak memory of a run is modeled as `fixed + per_sample * batch_size`. Both
+terms are measured by running the workload at two small batch sizes:
+
+  cuda: `torch.cuda.max_memory_allocated()` above the memory allocated before
+    the run (the weights are already there and are not counted).
+  cpu: resident set size of the process, sampled by a background thread, above
+    the size before the run. Memory freed earlier and reused by the allocator
+    does not raise the resident size, so this can read too low. A per-sample
+    measurement below the bytes of the tensors a sample certainly needs is
+    treated as unreliable, and `FALLBACK_BATCH_SIZE` is used instead.
+
+The largest batch size whose estimate fits into the memory budget is used. The
+budget is `Model_Settings.MEMORY_BUDGET` bytes, or the free memory of the device
+times `Model_Settings.MEMORY_SAFETY` if it is `None`. The measurements (not the
+batch sizes, so a new budget needs no new probe) are cached in
+`Model_Settings.MEMORY_PROBE_CACHE` per host, device and configuration.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+# 使用绝对路径
+import GAN.Model_Settings as Model_Settings
+
+__all__ = ['memory_budget', 'measure_peak_bytes', 'probe', 'safe_batch_size',
+           'synthesis_batch_size', 'inversion_batch_size']
+
+# 无法可靠测量时使用的batch大小
+FALLBACK_BATCH_SIZE = 8
+
+
+def _device_name(device):
+  device = torch.device(device)
+  if device.type == 'cuda':
+    return torch.cuda.get_device_name(device)
+  return 'cpu'
+
+
+def _available_ram():
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def memory_budget(device):
+  """Gets the memory budget (in bytes) of the batches on `device`."""
+  if Model_Settings.MEMORY_BUDGET is not None:
+    return int(Model_Settings.MEMORY_BUDGET)
+  device = torch.device(device)
+  if device.type == 'cuda':
+    free, _ = torch.cuda.mem_get_info(device)
+    # pytorch缓存但未使用的显存也可以使用
+    free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+  else:
+    free = _available_ram()
+  return int(free * Model_Settings.MEMORY_SAFETY)
+
+
+# 进程当前的常驻内存, 没有/proc时返回None
+# (ru_maxrss是整个进程生命周期的峰值, 之前的大块分配会让差值接近0, 不能使用)
+def _rss():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except OSError:
+    return None
+
+
+# cpu上没有分配器的峰值统计, 用后台线程采样进程的常驻内存
+class _RSSSampler(threading.Thread):
+  def __init__(self, interval=0.001):
+    super().__init__(daemon=True)
+    self.interval = interval
+    self.peak = _rss()
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.peak = max(self.peak, _rss())
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
+    self.peak = max(self.peak, _rss())
+    return self.peak
+
+
+def measure_peak_bytes(run_fn, device):
+  """Measures the peak memory (in bytes) of `run_fn()` above the memory in use.
+
+  Returns:
+    The peak bytes, or `None` if the memory of `device` cannot be measured.
+
+  Raises:
+    RuntimeError: If `run_fn` runs out of memory.
+  """
+  device = torch.device(device)
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    run_fn()
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device) - base
+  base = _rss()
+  if base is None:
+    run_fn()
+    return None
+  sampler = _RSSSampler()
+  sampler.start()
+  try:
+    run_fn()
+  finally:
+    peak = sampler.stop()
+  return max(peak - base, 0)
+
+
+def _cache_key(device, config):
+  return '|'.join([_device_name(device), f'torch{torch.__version__}'] +
+                  [f'{key}={config[key]}' for key in sorted(config)])
+
+
+def _load_cache():
+  path = Model_Settings.MEMORY_PROBE_CACHE
+  if not os.path.isfile(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
+
+
+def _save_cache(cache):
+  path = Model_Settings.MEMORY_PROBE_CACHE
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path + '.tmp', 'w') as f:
+    json.dump(cache, f, indent=2, sort_keys=True)
+  os.replace(path + '.tmp', path)   # 多个进程同时写入时不会留下不完整的文件
+
+
+def probe(run_batch, device, config, min_per_sample=0, probe_sizes=(1, 2)):
+  """Measures (or reads from the cache) the memory model of a workload.
+
+  Args:
+    run_batch: Callable running the workload with a batch size.
+    device: Device of the workload.
+    config: Dictionary identifying the workload, used as the cache key
+      together with the host and the device.
+    min_per_sample: Bytes a sample needs for sure (e.g. its output image). A
+      smaller measurement is unreliable. (default: 0)
+    probe_sizes: The two batch sizes to measure with. (default: (1, 2))
+
+  Returns:
+    A dictionary with `fixed` and `per_sample` bytes, or `None` if the
+      memory cannot be measured reliably (not cached, so it is retried).
+  """
+  host = socket.gethostname()
+  key = _cache_key(device, config)
+  cache = _load_cache()
+  if key in cache.get(host, {}):
+    return cache[host][key]
+
+  small, large = probe_sizes
+  run_batch(small)    # 预热, 不计入首次运行时的初始化(如cudnn的workspace)
+  peak_small = measure_peak_bytes(lambda: run_batch(small), device)
+  peak_large = measure_peak_bytes(lambda: run_batch(large), device)
+  if peak_small is None or peak_large is None:
+    return None
+  increment = (peak_large - peak_small) / (large - small)
+  if increment < min_per_sample:    # 增加的样本连必需的张量都放不下, 测量被内存复用掩盖了
+    return None
+  # 采样有误差, 保证每个样本的内存为正
+  per_sample = max(increment, peak_large / large)
+  result = {'fixed': max(peak_large - per_sample * large, 0.),
+            'per_sample': per_sample}
+
+  cache = _load_cache()
+  cache.setdefault(host, {})[key] = result
+  _save_cache(cache)
+  return result
+
+
+def safe_batch_size(measurement, budget, max_batch_size=None):
+  """Gets the largest batch size whose peak memory fits into `budget`."""
+  batch_size = int((budget - measurement['fixed']) // max(measurement['per_sample'], 1))
+  if max_batch_size is not None:
+    batch_size = min(batch_size, max_batch_size)
+  return max(batch_size, 1)
+
+
+def _is_oom(error):
+  return 'out of memory' in str(error)
+
+
+def _default_logger():
+  from GAN.base_generator import get_temp_logger    # base_generator引用了本模块, 在这里引用避免循环
+  return get_temp_logger('memory_probe')
+
+
+# 测量并选择batch大小, 测量失败或者不可靠时退回到FALLBACK_BATCH_SIZE
+def _pick_batch_size(run_batch, device, config, min_per_sample, max_batch_size,
+                     budget, logger, name):
+  try:
+    measurement = probe(run_batch, device, config, min_per_sample)
+  except RuntimeError as error:
+    if not _is_oom(error):
+      raise
+    logger.warning(f'Out of memory when probing the batch size of {name}, '
+                   f'use 1.')
+    return 1
+  finally:
+    if torch.device(device).type == 'cuda':
+      torch.cuda.empty_cache()
+  if measurement is None:
+    batch_size = FALLBACK_BATCH_SIZE if max_batch_size is None else \
+        min(FALLBACK_BATCH_SIZE, max_batch_size)
+    logger.warning(f'The peak memory of {name} on `{device}` cannot be '
+                   f'measured reliably, use batch size {batch_size}.')
+    return batch_size
+  batch_size = safe_batch_size(
+      measurement, budget or memory_budget(device), max_batch_size)
+  logger.info(f'Batch size {batch_size} for {name} '
+              f'({measurement["per_sample"] / 2 ** 20:.1f} MB per sample).')
+  return batch_size
+
+
+def synthesis_batch_size(generator, max_batch_size=None, budget=None):
+  """Gets the batch size of `generator.synthesize()` (a `BaseGenerator`)."""
+  device = generator.run_device
+
+  def run_batch(batch_size):
+    with torch.no_grad():
+      generator.net(torch.randn(batch_size, generator.z_space_dim, device=device))
+
+  config = {'task': 'synthesis', 'model': generator.model_name}
+  # 至少需要保存输出的图片
+  min_per_sample = generator.image_channels * generator.resolution ** 2 * 4
+  return _pick_batch_size(run_batch, device, config, min_per_sample,
+                          max_batch_size, budget, generator.logger,
+                          f'`{generator.model_name}`')
+
+
+def inversion_batch_size(generator, loss, target, args, device,
+                         max_batch_size=None, budget=None, logger=None):
+  """Gets the batch size of one inversion step (forward, loss and backward).
+
+  Args:
+    generator: Derivable generator (`Derivable_Generator.py`).
+    loss: Loss function exactly as used by the inversion.
+    target: One target image with shape [1, channel, height, width], as given
+      to the inversion. It is repeated to the batch size.
+    args: Arguments of the driver. The options changing the memory are used
+      as the cache key.
+    device: Device of the inversion.
+    max_batch_size: Upper bound, e.g. the number of images. (default: None)
+    budget: Memory budget in bytes. `None` for `memory_budget(device)`.
+    logger: Logger for the messages. `None` for a default one.
+  """
+  resolution = Model_Settings.MODEL_POOL[args.gan_model]['resolution']
+  target = target.to(device)
+
+  def run_batch(batch_size):
+    if getattr(generator, 'init', False):
+      latents = list(generator.init_value(batch_size, device=device))
+    else:
+      latents = [torch.randn((batch_size,) + size, device=device)
+                 for size in generator.input_size()]
+    for latent in latents:
+      latent.requires_grad = True
+    loss(generator(latents), target.repeat(batch_size, 1, 1, 1)).sum().backward()
+
+  config = {'task': 'inversion', 'model': args.gan_model,
+            'target': 'x'.join(str(d) for d in target.shape[1:])}
+  for name in ['inversion_type', 'z_number', 'private_z_number',
+               'composing_layer', 'checkpoint_blocks', 'loss_type',
+               'image_size', 'vgg_layer', 'vgg_layers', 'light_vgg_layer',
+               'light_channel_ratio', 'sr_mode', 'factor', 'down']:
+    config[name] = getattr(args, name, None)
+  # 至少需要保存生成的图片和它的梯度
+  min_per_sample = 2 * 3 * resolution ** 2 * 4
+  return _pick_batch_size(run_batch, device, config, min_per_sample,
+                          max_batch_size, budget, logger or _default_logger(),
+                          'the inversion')
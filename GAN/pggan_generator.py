@@ -18,11 +18,39 @@ from GAN.base_generator import BaseGenerator
 from GAN.pggan_generator_network import PGGANGeneratorNet
 
 import pickle
-import warnings
-warnings.filterwarnings('ignore', category=FutureWarning)
-import tensorflow as tf
 
-__all__ = ['PGGANGenerator']
+__all__ = ['PGGANGenerator', 'convert_tf_variables']
+
+
+# tensorflow变量 --> pytorch权重, 只依赖numpy数组, 不需要tensorflow
+def convert_tf_variables(tf_vars, net, logger=None):
+  """Converts the variables of the official tensorflow PGGAN generator.
+
+  Args:
+    tf_vars: Dictionary from tensorflow variable name to `numpy.ndarray`.
+    net: The `PGGANGeneratorNet` to convert for.
+    logger: Logger for recording the converted variables. (default: None)
+
+  Returns:
+    The state dict of `net` with the converted variables.
+  """
+  state_dict = net.state_dict()
+  for pth_var_name, tf_var_name in net.pth_to_tf_var_mapping.items():
+    assert tf_var_name in tf_vars
+    assert pth_var_name in state_dict
+    if logger is not None:
+      logger.debug(f'  Converting `{tf_var_name}` to `{pth_var_name}`.')
+    var = torch.from_numpy(np.array(tf_vars[tf_var_name]))
+    if 'weight' in pth_var_name:
+      if 'layer0.conv' in pth_var_name:
+        var = var.view(var.shape[0], -1, net.init_res, net.init_res)
+        var = var.permute(1, 0, 2, 3).flip(2, 3)
+      elif 'conv' in pth_var_name:
+        var = var.permute(3, 2, 0, 1)
+      elif 'conv' not in pth_var_name:
+        var = var.permute(0, 1, 3, 2)
+    state_dict[pth_var_name] = var
+  return state_dict
 
 
 class PGGANGenerator(BaseGenerator):
@@ -46,7 +74,10 @@ class PGGANGenerator(BaseGenerator):
   # 转化tensorflow张量到pytorch张量
   def convert_tf_weights(self, test_num=10):
     # pylint: disable=import-outside-toplevel
-    ### 待完成***************************************************************************
+    # tensorflow只在转换权重时用到, 导入很慢, 因此推迟到这里
+    import warnings
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    import tensorflow as tf
     tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
     # pylint: enable=import-outside-toplevel
 
@@ -64,25 +95,12 @@ class PGGANGenerator(BaseGenerator):
     # 转化  tensorflow权重 -->  pytorch权重
     self.logger.info(f'Converting tf weights to pytorch version.')
     tf_vars = dict(tf_net.__getstate__()['variables'])
-    state_dict = self.net.state_dict()
-    for pth_var_name, tf_var_name in self.net.pth_to_tf_var_mapping.items():
-      assert tf_var_name in tf_vars
-      assert pth_var_name in state_dict
-      self.logger.debug(f'  Converting `{tf_var_name}` to `{pth_var_name}`.')
-      var = torch.from_numpy(np.array(tf_vars[tf_var_name]))
-      if 'weight' in pth_var_name:
-        if 'layer0.conv' in pth_var_name:
-          var = var.view(var.shape[0], -1, self.net.init_res, self.net.init_res)
-          var = var.permute(1, 0, 2, 3).flip(2, 3)
-        elif 'conv' in pth_var_name:
-          var = var.permute(3, 2, 0, 1)
-        elif 'conv' not in pth_var_name:
-          var = var.permute(0, 1, 3, 2)
-      state_dict[pth_var_name] = var
+    state_dict = convert_tf_variables(tf_vars, self.net, self.logger)
     self.logger.info(f'Successfully converted!')
 
     # 保存
     self.logger.info(f'Saving pytorch weights to `{self.weight_path}`.')
+    os.makedirs(os.path.dirname(self.weight_path), exist_ok=True)
     for var_name in self.model_specific_vars:
       del state_dict[var_name]
     torch.save(state_dict, self.weight_path)
@@ -128,8 +146,8 @@ class PGGANGenerator(BaseGenerator):
     latent_codes = latent_codes / norm * np.sqrt(self.z_space_dim)
     return latent_codes.astype(np.float32)
 
-  # 从latent codes中生成图片  *********************************
-  def _synthesize(self, latent_codes):
+  # 检查latent codes的类型和形状
+  def _check_latent_codes(self, latent_codes):
     if not isinstance(latent_codes, np.ndarray):
       raise ValueError(f'Latent codes should be with type `numpy.ndarray`!')
     if not (len(latent_codes.shape) == 2 and
@@ -141,12 +159,22 @@ class PGGANGenerator(BaseGenerator):
                        f'{self.z_space_dim}!\n'
                        f'But {latent_codes.shape} received!')
 
+  # 在设备上生成图片, postprocess为True时在设备上转换为uint8
+  def _forward(self, latent_codes, postprocess=False):
+    self._check_latent_codes(latent_codes)
     zs = torch.from_numpy(latent_codes).type(torch.FloatTensor)   # 转化为pytorch tensor
     zs = zs.to(self.run_device)   # 放入GPU运算
-    images = self.net(zs)
+    with torch.no_grad():
+      images = self.net(zs)
+      if postprocess:
+        images = self.postprocess_tensor(images, to_host=False)
+    return images
+
+  # 从latent codes中生成图片  *********************************
+  def _synthesize(self, latent_codes, postprocess=False):
     results = {
         'z': latent_codes,
-        'image': self.get_value(images),
+        'image': self.get_value(self._forward(latent_codes, postprocess)),
     }
 
     if self.use_cuda:
@@ -154,6 +182,46 @@ class PGGANGenerator(BaseGenerator):
 
     return results
 
+  # 流水线的后处理, 在线程池中运行
+  # 在GPU上运行时图片已经在设备上后处理过, 这里只拷贝出固定内存缓冲区
+  def _host_postprocess(self, latent_codes, images, postprocess, callback):
+    if postprocess and not self.use_cuda:
+      images = self.postprocess(images)
+    elif self.use_cuda:   # 固定内存缓冲区会被复用
+      images = images.copy()
+    results = {'z': latent_codes, 'image': images}
+    if callback is not None:
+      callback(results)
+    return results
+
   # 分批运行
-  def synthesize(self, latent_codes, **kwargs):
-    return self.batch_run(latent_codes, self._synthesize)
+  def synthesize(self, latent_codes, output_path=None, postprocess=False,
+                 callback=None, **kwargs):
+    """Synthesizes images with given latent codes.
+
+    With `self.pipelined` the forward of the next batch overlaps with the copy
+    to host and the postprocessing of the current batch (see
+    `BaseGenerator.pipeline_iter()`) and the cuda cache is kept between
+    batches, otherwise the batches run one by one.
+
+    Args:
+      latent_codes: Input latent codes for image synthesis.
+      output_path: See `BaseGenerator.batch_run()`. (default: None)
+      postprocess: Whether to return the postprocessed images. (default: False)
+      callback: Called with the outputs of every batch, e.g. to encode the
+        images. Runs on the worker thread in the pipelined mode.
+        (default: None)
+    """
+    if not self.pipelined:
+      def run_fn(batch):
+        results = self._synthesize(batch, postprocess)
+        if callback is not None:
+          callback(results)
+        return results
+      return self.batch_run(latent_codes, run_fn, output_path=output_path)
+    outputs = self.pipeline_iter(
+        latent_codes,
+        lambda batch: self._forward(batch, postprocess and self.use_cuda),
+        lambda batch, images: self._host_postprocess(batch, images, postprocess,
+                                                     callback))
+    return self.collect_outputs(outputs, latent_codes.shape[0], output_path)
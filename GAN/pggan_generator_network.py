@@ -16,7 +16,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 # 开放接口
-__all__ = ['PGGANGeneratorNet']
+__all__ = ['PGGANGeneratorNet', 'get_composing_layers']
 
 # Resolutions allowed.
 _RESOLUTIONS_ALLOWED = [8, 16, 32, 64, 128, 256, 512, 1024]
@@ -25,6 +25,41 @@ _RESOLUTIONS_ALLOWED = [8, 16, 32, 64, 128, 256, 512, 1024]
 _INIT_RES = 4
 
 
+# 只由网络的设置计算, 不需要构建网络或者前向传播
+def get_composing_layers(resolution,
+                         image_channels=3,
+                         fmaps_base=16 << 10,
+                         fmaps_max=512):
+  """Gets the layers used to synthesize the final image layer by layer.
+
+  The intermediate `output` layers (only used for progressive growing) are
+  skipped, so the final image comes from the last `output` layer. The
+  arguments are the same as those of `PGGANGeneratorNet`.
+
+  Returns:
+    A list of `(layer_name, (channels, height, width))`, in execution order,
+      where the shape is the output shape of the layer.
+
+  Raises:
+    ValueError: If the input `resolution` is not supported.
+  """
+  if resolution not in _RESOLUTIONS_ALLOWED:
+    raise ValueError(f'Invalid resolution: {resolution}!\n'
+                     f'Resolutions allowed: {_RESOLUTIONS_ALLOWED}.')
+  init_res_log2 = int(np.log2(_INIT_RES))
+  final_res_log2 = int(np.log2(resolution))
+  layers = []
+  for res_log2 in range(init_res_log2, final_res_log2 + 1):
+    res = 2 ** res_log2
+    block_idx = res_log2 - init_res_log2
+    nf = min(fmaps_base // res, fmaps_max)
+    layers.append((f'layer{2 * block_idx}', (nf, res, res)))
+    layers.append((f'layer{2 * block_idx + 1}', (nf, res, res)))
+  block_idx = final_res_log2 - init_res_log2
+  layers.append((f'output{block_idx}', (image_channels, resolution, resolution)))
+  return layers
+
+
 class PGGANGeneratorNet(nn.Module):
   """Defines the generator network in PGGAN.
 
@@ -169,6 +204,15 @@ class PGGANGeneratorNet(nn.Module):
     """Gets number of feature maps according to current resolution."""
     return min(self.fmaps_base // res, self.fmaps_max)
 
+  # 逐层合成时使用的层(去掉了中间分辨率的输出层)及其输出尺寸, 见get_composing_layers()
+  def get_composing_layers(self):
+    """Gets the layers used to synthesize the final image layer by layer.
+
+    See the function `get_composing_layers()`.
+    """
+    return get_composing_layers(self.resolution, self.image_channels,
+                                self.fmaps_base, self.fmaps_max)
+
   # 搭建网络
   def forward(self, z):
     if not (len(z.shape) == 2 and z.shape[1] == self.z_space_dim):
@@ -0,0 +1,67 @@
+"""Measures the cold start (import time) of the entry points.
+
+Every measurement imports the module in a fresh interpreter, so nothing is cached in `sys.modules`.
+The slowest imported packages are taken from `python -X importtime`.
+
+python benchmarks/import_time.py --modules multi_latent_code_inversion,super_resolution --repeats 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.dirname(__file__) + '/' + '..')
+
+
+def _run(module, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', 'import %s' % module]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('Importing `%s` failed:\n%s' % (module, result.stderr))
+    return elapsed, result.stderr
+
+
+# 解析`-X importtime`的输出, 返回累计耗时最长的包(不含被测模块自身)
+# 每个包只在第一次导入时出现, 包名那一行的累计耗时即导入整个包的耗时
+def slowest_packages(importtime_output, module, top=10):
+    packages = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [field.strip() for field in line[len('import time:'):].split('|')]
+        if '.' not in name and name != module:
+            packages[name] = max(packages.get(name, 0), int(cumulative) / 1e6)
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def main(args):
+    report = {}
+    for module in args.modules.split(','):
+        timings = sorted(_run(module)[0] for _ in range(args.repeats))
+        _, importtime_output = _run(module, importtime=True)
+        report[module] = {'median_s': timings[len(timings) // 2],
+                          'min_s': timings[0],
+                          'slowest_packages': slowest_packages(importtime_output, module)}
+        print('%s: median %.2f s, min %.2f s' % (module, report[module]['median_s'], report[module]['min_s']))
+        for package, seconds in report[module]['slowest_packages']:
+            print('    %-24s %.3f s' % (package, seconds))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time of the entry points')
+    parser.add_argument('--modules', default='multi_latent_code_inversion,super_resolution',
+                        help='Comma separated modules to import.')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help='Json file to save the report.')
+
+    args, other_args = parser.parse_known_args()
+    main(args)
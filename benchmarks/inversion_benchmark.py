@@ -0,0 +1,184 @@
+"""Time-to-quality benchmark of GAN inversion.
+
+The targets are synthesized by the generator from known latent codes (fixed seed), so the ground truth exists
+and every image is reachable. Every combination of `--inversion_types`, `--optimizations`, `--z_numbers`,
+`--composing_layers` and `--loss_types` inverts the same targets, and PSNR / SSIM of the reconstruction are
+recorded every `--eval_every` steps together with the wall-clock time of the optimization (evaluation excluded).
+
+The JSON report holds the full quality curves, the time to reach every `--psnr_targets` and the Pareto front
+of final PSNR against time.
+
+MGAN_FIXTURE_MODE=1 python benchmarks/inversion_benchmark.py --gan_model pggan_fixture256 \\
+    --z_numbers 10,30 --loss_types L2,Combine --iterations 200 --output inversion.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+from Derivable_Models.Derivable_Generator import get_derivable_generator
+from Derivable_Models.Gan_Utils import get_gan_model
+from inversion.hooks import InversionHook
+from inversion.inversion_methods import get_inversion
+from inversion.losses import get_loss
+from utils.image_metrics import psnr, ssim
+from utils.image_precossing import _tanh_to_sigmoid
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+# 每eval_every步评估一次当前重建的质量, 评估的耗时不计入优化时间
+class QualityTracker(InversionHook):
+    def __init__(self, generator, target, eval_every, device):
+        self.generator = generator
+        self.target = _tanh_to_sigmoid(target)
+        self.eval_every = eval_every
+        self.device = device
+        self.latent_estimate = None
+        self.records = []
+        self.start = None
+        self.excluded = 0.
+
+    def on_begin(self, latent_estimate):
+        self.latent_estimate = latent_estimate
+        self.records = []
+        self.excluded = 0.
+        _sync(self.device)
+        self.start = time.perf_counter()
+
+    def evaluate(self, step):
+        _sync(self.device)
+        now = time.perf_counter()
+        with torch.no_grad():
+            estimate = torch.clamp(_tanh_to_sigmoid(self.generator(self.latent_estimate)), min=0., max=1.)
+            self.records.append({'step': step,
+                                 'seconds': now - self.start - self.excluded,
+                                 'psnr': psnr(estimate, self.target).mean().item(),
+                                 'ssim': ssim(estimate, self.target).mean().item()})
+        self.excluded += time.perf_counter() - now
+
+    def on_step(self, step, loss):
+        if (step + 1) % self.eval_every == 0:
+            self.evaluate(step + 1)
+
+    def on_end(self, latent_estimate, losses):
+        if not self.records or self.records[-1]['step'] != len(losses):
+            self.evaluate(len(losses))
+
+
+def make_targets(args):
+    gan = get_gan_model(args.gan_model, args.device)
+    z = torch.randn((args.num_images, 512, 1, 1), generator=torch.Generator().manual_seed(args.seed))
+    with torch.no_grad():
+        # 生成器的输出没有tanh, 可能超出[-1, 1]; 与驱动脚本读入的图片一样限制值域, 使目标和重建结果的处理一致
+        return torch.clamp(gan(z.to(args.device)), min=-1., max=1.)
+
+
+def time_to_quality(records, psnr_targets):
+    return {str(target): next((r['seconds'] for r in records if r['psnr'] >= target), None)
+            for target in psnr_targets}
+
+
+# 最终PSNR和耗时的帕累托前沿: 没有其他配置同时更快且更好
+def pareto_front(results):
+    front = []
+    for r in results:
+        dominated = any(o['final']['seconds'] <= r['final']['seconds'] and o['final']['psnr'] >= r['final']['psnr']
+                        and (o['final']['seconds'], o['final']['psnr']) != (r['final']['seconds'], r['final']['psnr'])
+                        for o in results)
+        if not dominated:
+            front.append(r)
+    return sorted(front, key=lambda r: r['final']['seconds'])
+
+
+def run_config(config, targets, args):
+    run_args = argparse.Namespace(**vars(args))
+    for key, value in config.items():
+        setattr(run_args, key, value)
+    generator = get_derivable_generator(args.gan_model, config['inversion_type'], run_args)
+    generator.to(args.device)
+    loss = get_loss(config['loss_type'], run_args).to(args.device)
+    inversion = get_inversion(config['optimization'], run_args)
+    tracker = inversion.register_hook(QualityTracker(generator, targets, args.eval_every, args.device))
+    inversion.invert(generator, targets, loss, batch_size=targets.size()[0])
+    result = dict(config)
+    result['curve'] = tracker.records
+    result['final'] = tracker.records[-1]
+    result['time_to_psnr'] = time_to_quality(tracker.records, args.psnr_targets)
+    return result
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    args.psnr_targets = [float(v) for v in args.psnr_targets.split(',')]
+    targets = make_targets(args)
+    sweep = [dict(zip(['inversion_type', 'optimization', 'z_number', 'composing_layer', 'loss_type'], values))
+             for values in itertools.product(args.inversion_types.split(','), args.optimizations.split(','),
+                                             [int(v) for v in args.z_numbers.split(',')],
+                                             [int(v) for v in args.composing_layers.split(',')],
+                                             args.loss_types.split(','))]
+    # 单个latent code的反演与z_number和composing_layer无关, 只运行一次
+    for config in sweep:
+        if config['inversion_type'] == 'PGGAN-z':
+            config['z_number'] = config['composing_layer'] = None
+    sweep = [config for i, config in enumerate(sweep) if config not in sweep[:i]]
+    results = []
+    for config in sweep:
+        torch.manual_seed(args.seed)
+        result = run_config(config, targets, args)
+        results.append(result)
+        print('%s: PSNR %.2f dB, SSIM %.4f, %.1f s, %d steps'
+              % (', '.join('%s=%s' % item for item in config.items()), result['final']['psnr'],
+                 result['final']['ssim'], result['final']['seconds'], result['final']['step']))
+    front = pareto_front(results)
+    print('Pareto front (final PSNR against time):')
+    for r in front:
+        print('    %6.1f s  %6.2f dB  %s' % (r['final']['seconds'], r['final']['psnr'],
+                                           ', '.join('%s=%s' % (k, r[k]) for k in sweep[0])))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'gan_model': args.gan_model, 'num_images': args.num_images, 'iterations': args.iterations,
+                       'device': args.device, 'results': results,
+                       'pareto_front': [results.index(r) for r in front]}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time-to-quality benchmark of GAN inversion')
+    parser.add_argument('--gan_model', default='pggan_churchoutdoor')
+    parser.add_argument('--num_images', type=int, default=4, help='Number of targets, inverted as one batch.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the target latent codes and the inversion.')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--threads', type=int, default=0, help='Number of cpu threads. 0 for torch default.')
+    parser.add_argument('--eval_every', type=int, default=50, help='Evaluate the quality every N steps.')
+    parser.add_argument('--psnr_targets', default='20,25,30', help='Report the time to reach these PSNRs.')
+    parser.add_argument('--output', default=None, help='Json file to save the report.')
+    # Sweep
+    parser.add_argument('--inversion_types', default='PGGAN-Multi-Z')
+    parser.add_argument('--optimizations', default='GD')
+    parser.add_argument('--z_numbers', default='30')
+    parser.add_argument('--composing_layers', default='6')
+    parser.add_argument('--loss_types', default='Combine')
+    # Other parameters, the same as the drivers
+    parser.add_argument('--init_type', default='Normal')
+    parser.add_argument('--lr', type=float, default=1.)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--vgg_loss_type', default='L1')
+    parser.add_argument('--vgg_layer', type=int, default=16)
+    parser.add_argument('--l1_lambda', type=float, default=0.)
+    parser.add_argument('--l2_lambda', type=float, default=1.)
+    parser.add_argument('--vgg_lambda', type=float, default=1.)
+
+    args, other_args = parser.parse_known_args()
+    main(args)
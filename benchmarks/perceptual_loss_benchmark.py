@@ -0,0 +1,135 @@
+"""Compares the cost and the inversion quality of the perceptual losses.
+
+Cost: time of one forward + backward of every loss type on random images.
+Quality (optional, needs `--target_images`): PSNR of a short inversion with every loss type.
+
+python benchmarks/perceptual_loss_benchmark.py --device cpu --loss_types Combine,CombineLight
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+from Derivable_Models.Derivable_Generator import get_derivable_generator
+from GAN.Model_Settings import MODEL_POOL
+from inversion.inversion_methods import get_inversion
+from inversion.losses import get_loss
+from utils.file_utils import image_files, load_as_tensor
+from utils.image_metrics import psnr
+from utils.image_precossing import _sigmoid_to_tanh, _tanh_to_sigmoid, _add_batch_one
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+# 一次前向+反向传播的耗时
+def time_loss(loss, args):
+    x = torch.rand((args.batch_size, 3, args.input_size, args.input_size), device=args.device) * 2 - 1
+    gt = torch.rand((args.batch_size, 3, args.input_size, args.input_size), device=args.device) * 2 - 1
+    x.requires_grad = True
+    timings = []
+    for i in range(args.warmup + args.repeats):
+        _sync(args.device)
+        start = time.perf_counter()
+        loss(x, gt).backward()
+        _sync(args.device)
+        if i >= args.warmup:
+            timings.append(time.perf_counter() - start)
+        x.grad = None
+    timings.sort()
+    return {'mean_ms': 1000 * sum(timings) / len(timings),
+            'median_ms': 1000 * timings[len(timings) // 2],
+            'min_ms': 1000 * timings[0]}
+
+
+# 用每种loss做一次较短的反演, 记录重建的PSNR和耗时
+def inversion_quality(loss, args):
+    generator = get_derivable_generator(args.gan_model, args.inversion_type, args)
+    generator.to(args.device)
+    inversion = get_inversion(args.optimization, args)
+    resolution = MODEL_POOL[args.gan_model]['resolution']
+    results = []
+    for image in image_files(args.target_images)[:args.num_images]:
+        y_gt = _add_batch_one(load_as_tensor(image)).to(args.device)
+        if y_gt.size()[2] != resolution or y_gt.size()[3] != resolution:
+            y_gt = F.interpolate(y_gt, size=resolution, mode='area')
+        y_gt = _sigmoid_to_tanh(y_gt)
+        start = time.perf_counter()
+        latent_estimates, _ = inversion.invert(generator, y_gt, loss, batch_size=1)
+        _sync(args.device)
+        elapsed = time.perf_counter() - start
+        with torch.no_grad():
+            y_estimate = torch.clamp(_tanh_to_sigmoid(generator(latent_estimates)), min=0., max=1.)
+        results.append({'image': os.path.split(image)[1],
+                        'psnr': psnr(y_estimate, _tanh_to_sigmoid(y_gt)).item(),
+                        'seconds': elapsed})
+    return results
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    report = {'device': args.device, 'image_size': args.image_size, 'input_size': args.input_size,
+              'batch_size': args.batch_size, 'losses': {}}
+    for loss_type in args.loss_types.split(','):
+        loss = get_loss(loss_type, args).to(args.device)
+        result = {'cost': time_loss(loss, args)}
+        print('%-14s forward+backward: %.2f ms (median %.2f ms)'
+              % (loss_type, result['cost']['mean_ms'], result['cost']['median_ms']))
+        if args.target_images:
+            result['inversion'] = inversion_quality(loss, args)
+            mean_psnr = sum(r['psnr'] for r in result['inversion']) / max(len(result['inversion']), 1)
+            mean_seconds = sum(r['seconds'] for r in result['inversion']) / max(len(result['inversion']), 1)
+            print('%-14s inversion: PSNR %.2f dB, %.1f s per image' % (loss_type, mean_psnr, mean_seconds))
+        report['losses'][loss_type] = result
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cost and quality of perceptual losses')
+    parser.add_argument('--loss_types', default='Combine,CombineLight',
+                        help='Comma separated loss types to compare.')
+    parser.add_argument('--device', default='cpu', help="['cpu', 'cuda'].")
+    parser.add_argument('--threads', type=int, default=0, help='Number of cpu threads. 0 for torch default.')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--input_size', type=int, default=256, help='Size of the images fed into the loss.')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--output', default=None, help='Json file to save the report.')
+    # Loss Parameters, the same as the drivers
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--vgg_loss_type', default='L1')
+    parser.add_argument('--vgg_layer', type=int, default=16)
+    parser.add_argument('--vgg_layers', default='')
+    parser.add_argument('--vgg_layer_weights', default='')
+    parser.add_argument('--vgg_resize', default='nearest')
+    parser.add_argument('--light_vgg_layer', type=int, default=9)
+    parser.add_argument('--light_channel_ratio', type=float, default=0.5)
+    parser.add_argument('--l1_lambda', type=float, default=0.)
+    parser.add_argument('--l2_lambda', type=float, default=1.)
+    parser.add_argument('--vgg_lambda', type=float, default=1.)
+    # Inversion quality, skipped if no target images are given
+    parser.add_argument('--target_images', default=None, help='Target images to invert.')
+    parser.add_argument('--num_images', type=int, default=4)
+    parser.add_argument('--gan_model', default='pggan_churchoutdoor')
+    parser.add_argument('--inversion_type', default='PGGAN-Multi-Z')
+    parser.add_argument('--composing_layer', type=int, default=6)
+    parser.add_argument('--z_number', type=int, default=30)
+    parser.add_argument('--optimization', default='GD')
+    parser.add_argument('--init_type', default='Normal')
+    parser.add_argument('--lr', type=float, default=1.)
+    parser.add_argument('--iterations', type=int, default=300)
+
+    args, other_args = parser.parse_known_args()
+    main(args)
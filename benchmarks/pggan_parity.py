@@ -0,0 +1,138 @@
+"""CPU parity check of the converted PGGAN weights.
+
+Runs the official tensorflow `G_paper` (`GAN/pggan_tf_official`) and `PGGANGeneratorNet` on the same fixed
+latent codes, and reports the max / mean absolute error at every output resolution (the `lod` of both networks
+is set to every level in turn). The tensorflow outputs are cached to `--reference_dir`, so later checks (e.g.
+after re-converting the weights) need no tensorflow. Both paths are timed as a synthesis throughput baseline.
+Generating the reference needs the environment of the official code (tensorflow 1.x, which `tfutil` is written
+for) and the official pickle; the graph runs on cpu even though `tfutil` places it on '/gpu:0'.
+
+python benchmarks/pggan_parity.py --gan_model pggan_churchoutdoor --num 16 --batch_size 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+from GAN.Model_Settings import MODEL_POOL
+from GAN.pggan_generator import PGGANGenerator
+
+
+def reference_path(args):
+    return os.path.join(args.reference_dir, '%s_seed%d_num%d.npz' % (args.gan_model, args.seed, args.num))
+
+
+# 用tensorflow官方实现在cpu上生成参考输出, 每个lod一组
+def tf_reference(latents, lods, args):
+    import pickle
+    import tensorflow as tf
+    settings = MODEL_POOL[args.gan_model]
+    sys.path.insert(0, settings['tf_code_path'])
+    import tfutil
+    # tfutil.Network.run()把运算固定在'/gpu:0'上, 需要允许放到cpu上运行
+    config = tf.compat.v1.ConfigProto(device_count={'GPU': 0}, allow_soft_placement=True,
+                                      intra_op_parallelism_threads=args.threads,
+                                      inter_op_parallelism_threads=args.threads)
+    with tf.compat.v1.Session(config=config).as_default():
+        with open(settings['tf_weight_path'], 'rb') as f:
+            _, _, tf_net = pickle.load(f)  # G, D, Gs
+        labels = np.zeros((latents.shape[0], tf_net.input_shapes[1][1]), np.float32)
+        outputs, seconds = {}, {}
+        for lod in lods:
+            tfutil.set_vars({tf_net.find_var('lod'): np.float32(lod)})
+            tf_net.run(latents[:args.batch_size], labels[:args.batch_size], minibatch_size=args.batch_size)  # 预热
+            start = time.perf_counter()
+            outputs[lod] = tf_net.run(latents, labels, minibatch_size=args.batch_size)
+            seconds[lod] = time.perf_counter() - start
+    sys.path.pop(0)
+    return outputs, seconds
+
+
+def load_reference(latents, lods, args):
+    path = reference_path(args)
+    if os.path.isfile(path) and not args.regenerate:
+        print('Loading reference outputs from `%s`.' % path)
+        cache = np.load(path)
+        if not np.array_equal(cache['latents'], latents):
+            raise ValueError('Latent codes of `%s` do not match, please use `--regenerate`.' % path)
+        return ({lod: cache['lod%d' % lod] for lod in lods},
+                {lod: float(cache['seconds%d' % lod]) for lod in lods})
+    print('Generating reference outputs with tensorflow.')
+    outputs, seconds = tf_reference(latents, lods, args)
+    os.makedirs(args.reference_dir, exist_ok=True)
+    arrays = {'latents': latents}
+    for lod in lods:
+        arrays['lod%d' % lod] = outputs[lod]
+        arrays['seconds%d' % lod] = np.float64(seconds[lod])
+    np.savez_compressed(path, **arrays)
+    print('Saved reference outputs to `%s`.' % path)
+    return outputs, seconds
+
+
+def torch_outputs(net, latents, lod, args):
+    net.lod.data.fill_(lod)
+    with torch.no_grad():
+        net(torch.from_numpy(latents[:args.batch_size]).to(args.device))   # 预热
+        outputs = []
+        start = time.perf_counter()
+        for i in range(0, latents.shape[0], args.batch_size):
+            outputs.append(net(torch.from_numpy(latents[i:i + args.batch_size]).to(args.device)).cpu().numpy())
+        seconds = time.perf_counter() - start
+    return np.concatenate(outputs, axis=0), seconds
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    latents = np.random.RandomState(args.seed).randn(args.num, MODEL_POOL[args.gan_model]['z_space_dim'])
+    latents = latents.astype(np.float32)
+    generator = PGGANGenerator(args.gan_model)
+    net = generator.net.to(args.device)
+    lods = list(range(net.final_res_log2 - net.init_res_log2 + 1))
+    references, tf_seconds = load_reference(latents, lods, args)
+
+    report = {'gan_model': args.gan_model, 'num': args.num, 'batch_size': args.batch_size, 'resolutions': []}
+    passed = True
+    for lod in lods:
+        outputs, seconds = torch_outputs(net, latents, lod, args)
+        error = np.abs(outputs - references[lod])
+        result = {'resolution': 2 ** (net.final_res_log2 - lod), 'lod': lod,
+                  'max_error': float(error.max()), 'mean_error': float(error.mean()),
+                  'torch_images_per_second': args.num / seconds,
+                  'tf_images_per_second': args.num / tf_seconds[lod]}
+        passed = passed and result['max_error'] <= args.tolerance
+        report['resolutions'].append(result)
+        print('%4dx%-4d max error %.3e, mean error %.3e | torch %.2f img/s, tf %.2f img/s'
+              % (result['resolution'], result['resolution'], result['max_error'], result['mean_error'],
+                 result['torch_images_per_second'], result['tf_images_per_second']))
+    net.lod.data.fill_(generator.lod)
+    report['passed'] = passed
+    print('Parity %s (tolerance %.1e).' % ('passed' if passed else 'FAILED', args.tolerance))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parity of PGGANGeneratorNet with the official tensorflow G_paper')
+    parser.add_argument('--gan_model', default='pggan_churchoutdoor', help='Model in `MODEL_POOL`.')
+    parser.add_argument('--num', type=int, default=16, help='Number of latent codes.')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the latent codes.')
+    parser.add_argument('--device', default='cpu', help="Device of the pytorch path, ['cpu', 'cuda'].")
+    parser.add_argument('--threads', type=int, default=0, help='Number of cpu threads. 0 for the default.')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='Max absolute error allowed.')
+    parser.add_argument('--reference_dir', default='./parity_cache', help='Directory of the cached tensorflow outputs.')
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate the cached tensorflow outputs.')
+    parser.add_argument('--output', default=None, help='Json file to save the report.')
+
+    args, other_args = parser.parse_known_args()
+    sys.exit(0 if main(args) else 1)
@@ -0,0 +1,219 @@
+"""Synthesis throughput of `PGGANGenerator.synthesize` across models, batch sizes, threads and backends.
+
+Backends ('eager' is always available, the others are skipped with a note when the torch build lacks them):
+    eager       the network as it is
+    fused       torch.jit.trace + torch.jit.freeze, which folds constants and fuses ops
+    compiled    torch.compile
+    half        bfloat16 on cpu, float16 on cuda
+    quantized   dynamic int8 quantization of the convolutions
+
+Every configuration reports images/s, latency percentiles of one `synthesize` call, peak RSS and (on cuda)
+allocator stats. With `--pipelined` the batches of one call overlap, so only the throughput is reported and
+`latency_ms` is null. With `--compare baseline.json`, configurations slower than the baseline by more than
+`--tolerance` are flagged and the script exits with 1.
+
+The default models are the fixtures (`pggan_fixture256`, `pggan_fixture1024`), so no weights are needed.
+
+python benchmarks/synthesis_benchmark.py --batch_sizes 1,8 --backends eager,fused --output synthesis.json
+python benchmarks/synthesis_benchmark.py --batch_sizes 1,8 --backends eager,fused --compare synthesis.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+import GAN.Model_Settings as Model_Settings
+from Derivable_Models.Gan_Utils import build_generator
+
+BACKENDS = ['eager', 'fused', 'compiled', 'half', 'quantized']
+
+
+# 以低精度运行网络, 输出转换回float32
+class HalfPrecision(nn.Module):
+    def __init__(self, net, dtype):
+        super(HalfPrecision, self).__init__()
+        self.net = net.to(dtype)
+        self.dtype = dtype
+
+    def forward(self, z):
+        return self.net(z.to(self.dtype)).float()
+
+
+def build_backend(net, backend, example):
+    """
+    :return: (module running the synthesis, None) or (None, reason) if the backend is not available
+    """
+    if backend == 'eager':
+        return net, None
+    if backend == 'fused':
+        if not hasattr(torch.jit, 'freeze'):
+            return None, 'torch.jit.freeze is not available'
+        return torch.jit.freeze(torch.jit.trace(net, example)), None
+    if backend == 'compiled':
+        if not hasattr(torch, 'compile'):
+            return None, 'torch.compile is not available'
+        return torch.compile(net), None
+    if backend == 'half':
+        return HalfPrecision(net, torch.float16 if example.is_cuda else torch.bfloat16), None
+    if backend == 'quantized':
+        if example.is_cuda:
+            return None, 'quantized kernels are cpu only'
+        try:
+            from torch.ao.quantization import quantize_dynamic
+            quantized = quantize_dynamic(net, {nn.Conv2d}, dtype=torch.qint8)
+        except (ImportError, AssertionError, RuntimeError) as error:
+            return None, 'dynamic quantization failed: %s' % error
+        if not any(type(m).__module__.startswith('torch.ao.nn.quantized') for m in quantized.modules()):
+            return None, 'dynamic quantization of Conv2d is not supported by this torch'
+        return quantized, None
+    raise ValueError('Unsupported backend `%s`, please choose from %s.' % (backend, BACKENDS))
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.     # Linux上单位为KB
+
+
+def run_config(generator, batch_size, args):
+    latents = generator.easy_sample(args.num_images)
+    generator.batch_size = batch_size or None       # 0表示由memory_probe按内存预算选择
+    batch_size = generator.batch_size
+    # 'none'只计时合成, 否则计时合成和后处理, 'device'在设备上后处理
+    generator.postprocess_on_device = args.postprocess == 'device'
+    generator.pipelined = args.pipelined
+    synthesize = generator.synthesize if args.postprocess == 'none' else generator.easy_synthesize
+    if generator.use_cuda:
+        torch.cuda.reset_peak_memory_stats()
+    timings = []
+    with torch.no_grad():
+        for i in range(args.warmup):
+            synthesize(latents[:batch_size])
+        if generator.pipelined:
+            # 流水线只在一次调用的多个batch之间重叠, 只能对整体计时, 不统计每个batch的延迟
+            start = time.perf_counter()
+            synthesize(latents)
+            elapsed = time.perf_counter() - start
+        else:
+            for i in range(0, args.num_images, batch_size):
+                start = time.perf_counter()
+                synthesize(latents[i:i + batch_size])      # 返回numpy数组, 已经同步了设备
+                timings.append(time.perf_counter() - start)
+            elapsed = sum(timings)
+    result = {'images_per_second': args.num_images / elapsed,
+              'effective_batch_size': batch_size,
+              'latency_ms': None if generator.pipelined else
+              {'p50': 1000 * float(np.percentile(timings, 50)),
+               'p90': 1000 * float(np.percentile(timings, 90)),
+               'p99': 1000 * float(np.percentile(timings, 99))},
+              'peak_rss_mb': peak_rss_mb()}
+    if generator.use_cuda:
+        result['cuda_max_allocated_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        result['cuda_max_reserved_mb'] = torch.cuda.max_memory_reserved() / 2 ** 20
+    return result
+
+
+def config_key(config):
+    key = '%s/batch%d/threads%d/%s' % (config['gan_model'], config['batch_size'], config['threads'],
+                                       config['backend'])
+    if config.get('postprocess', 'none') != 'none':
+        key += '/postprocess-%s' % config['postprocess']
+    if config.get('pipelined', False):
+        key += '/pipelined'
+    return key
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return: list of the configurations slower than the baseline by more than `tolerance` (ratio)
+    """
+    baseline_results = {config_key(r): r for r in baseline['results'] if 'images_per_second' in r}
+    regressions = []
+    for result in report['results']:
+        key = config_key(result)
+        if key not in baseline_results or 'images_per_second' not in result:
+            continue
+        ratio = result['images_per_second'] / baseline_results[key]['images_per_second']
+        result['baseline_ratio'] = ratio
+        if ratio < 1. - tolerance:
+            regressions.append(key)
+            print('REGRESSION %s: %.2f img/s, baseline %.2f img/s (%.1f%%)'
+                  % (key, result['images_per_second'], baseline_results[key]['images_per_second'],
+                     100 * (ratio - 1)))
+    return regressions
+
+
+def main(args):
+    Model_Settings.USE_CUDA = args.device == 'cuda'
+    report = {'device': args.device, 'torch': torch.__version__, 'num_images': args.num_images, 'results': []}
+    for gan_model in args.gan_models.split(','):
+        generator = build_generator(gan_model, logger=logging.getLogger('synthesis_benchmark'))
+        eager_net = generator.net
+        example = torch.randn(1, generator.z_space_dim, device=generator.run_device)
+        for threads in [int(t) for t in args.threads.split(',')]:
+            if threads > 0:
+                torch.set_num_threads(threads)
+            for backend in args.backends.split(','):
+                with torch.no_grad():
+                    net, reason = build_backend(eager_net, backend, example)
+                for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+                    config = {'gan_model': gan_model, 'resolution': generator.resolution, 'batch_size': batch_size,
+                              'threads': torch.get_num_threads(), 'backend': backend,
+                              'postprocess': args.postprocess, 'pipelined': args.pipelined}
+                    if net is None:
+                        config['skipped'] = reason
+                        print('%s: skipped, %s' % (config_key(config), reason))
+                    else:
+                        generator.net = net
+                        config.update(run_config(generator, batch_size, args))
+                        latency = config['latency_ms']
+                        print('%s: %.2f img/s, %s, peak RSS %.0f MB'
+                              % (config_key(config), config['images_per_second'],
+                                 'p50 %.1f ms, p90 %.1f ms' % (latency['p50'], latency['p90'])
+                                 if latency is not None else 'no latency (pipelined)', config['peak_rss_mb']))
+                    report['results'].append(config)
+                generator.net = eager_net
+                if backend == 'half':       # HalfPrecision直接转换了原网络的精度, 需要恢复
+                    eager_net.float()
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+        print('%d regressions against `%s`.' % (len(regressions), args.compare))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return len(regressions) == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthesis throughput benchmark')
+    parser.add_argument('--gan_models', default='pggan_fixture256,pggan_fixture1024',
+                        help='Comma separated models in `MODEL_POOL`.')
+    parser.add_argument('--batch_sizes', default='1,4,8', help='Comma separated batch sizes. 0 for the largest batch fitting into the memory budget '
+                             '(see `GAN/memory_probe.py`).')
+    parser.add_argument('--threads', default='0', help='Comma separated numbers of cpu threads. 0 for the default.')
+    parser.add_argument('--backends', default='eager,fused', help='Comma separated backends of %s.' % BACKENDS)
+    parser.add_argument('--device', default='cpu', help="['cpu', 'cuda'].")
+    parser.add_argument('--postprocess', default='none', choices=['none', 'host', 'device'],
+                        help="Also time the postprocessing to uint8, in numpy ('host') or on the device ('device').")
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Overlap the forward of the next batch with the copy and postprocessing of the current one.')
+    parser.add_argument('--num_images', type=int, default=32, help='Number of images of every configuration.')
+    parser.add_argument('--warmup', type=int, default=2, help='Number of warmup batches.')
+    parser.add_argument('--output', default=None, help='Json file to save the report.')
+    parser.add_argument('--compare', default=None, help='Baseline report to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative slowdown against the baseline flagged as a regression.')
+
+    args, other_args = parser.parse_known_args()
+    sys.exit(0 if main(args) else 1)
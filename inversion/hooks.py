@@ -0,0 +1,103 @@
+import json
+import os
+import time
+
+import torch
+
+from tqdm import tqdm
+
+
+class InversionHook(object):
+    """
+    Base class of the per-iteration hooks of `GradientDescent.invert`.
+    Losses are accumulated on the device of the images and only copied to host every `log_every` steps,
+    so the hooks never force a device sync inside the optimization loop.
+    """
+    def on_begin(self, latent_estimate):
+        """
+        Called before the first step.
+        :param latent_estimate: list of the latent codes being optimized. The same list object is updated
+            in place during the optimization (also when codes are pruned), so it can be kept for later use.
+        """
+        pass
+
+    def on_step(self, step, loss):
+        """
+        Called after every optimization step.
+        :param step: index of the step, starts from 0
+        :param loss: detached 0-dim tensor, still on device. Calling `.item()` here forces a sync.
+        """
+        pass
+
+    def on_checkpoint(self, step, losses):
+        """
+        Called every `log_every` steps and after the last step.
+        :param step: number of finished steps
+        :param losses: 1D cpu tensor, losses of the steps since the last checkpoint
+        """
+        pass
+
+    def on_end(self, latent_estimate, losses):
+        """
+        Called when the optimization is finished.
+        :param latent_estimate: the optimized latent codes
+        :param losses: 1D cpu tensor, losses of all steps
+        """
+        pass
+
+
+# 记录loss曲线
+class LossLogger(InversionHook):
+    def __init__(self, path=None, verbose=True):
+        """
+        :param path: file to save the loss curve (json). None for no saving.
+        :param verbose: print the mean loss of every checkpoint
+        """
+        self.path = path
+        self.verbose = verbose
+        self.losses = []
+
+    def on_checkpoint(self, step, losses):
+        self.losses.extend(losses.tolist())
+        if self.verbose:
+            tqdm.write('step %d: loss %.6f (mean of last %d steps %.6f)'
+                       % (step, losses[-1].item(), len(losses), losses.mean().item()))
+
+    def on_end(self, latent_estimate, losses):
+        self.losses = losses.tolist()
+        if self.path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump({'loss': self.losses}, f)
+
+
+# 统计每步的平均耗时和显存峰值
+# 只在拷贝loss(会同步设备)时计时, 不在每步引入同步; 第一个记录区间包含了预热, 不参与统计
+class StepTimer(InversionHook):
+    def __init__(self, device=None):
+        self.device = device
+        self.records = []
+        self.step_time = None
+        self.peak_memory = None
+
+    def _cuda(self):
+        return torch.cuda.is_available() and (self.device is None or torch.device(self.device).type == 'cuda')
+
+    def on_step(self, step, loss):
+        if step == 0:
+            self.records = [(0, time.perf_counter())]
+            if self._cuda():
+                torch.cuda.reset_peak_memory_stats(self.device)
+
+    def on_checkpoint(self, step, losses):
+        self.records.append((step, time.perf_counter()))
+
+    def on_end(self, latent_estimate, losses):
+        records = self.records[1:] if len(self.records) > 2 else self.records
+        (first_step, first_time), (last_step, last_time) = records[0], records[-1]
+        self.step_time = (last_time - first_time) / max(last_step - first_step, 1)
+        message = 'Step time: %.2f ms' % (1000 * self.step_time)
+        if self._cuda():
+            self.peak_memory = torch.cuda.max_memory_allocated(self.device)
+            message += ', peak memory: %.1f MB' % (self.peak_memory / 2 ** 20)
+        tqdm.write(message)
@@ -1,10 +1,13 @@
 from tqdm import tqdm
 import copy
+import os
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 
+from inversion.lr_schedulers import get_lr_scheduler
+
 
 # 选取梯度下降算法
 def get_inversion(inversion_type, args):
@@ -20,10 +23,48 @@ class GradientDescent(object):
         self.lr = lr
         self.optimizer = optimizer
         self.init_type = args.init_type  # ['Zero', 'Normal']       # 随机初始化方式, zero()或者randn()
+        self.args = args    # 学习率调度器的参数
+        self.checkpoint_every = getattr(args, 'checkpoint_every', 0)    # 每隔多少步保存一次checkpoint, 0表示只保存最终结果
+        self.log_every = getattr(args, 'log_every', 0) or 100      # 每隔多少步将loss从设备拷贝回内存并通知hooks
+        self.hooks = []
+        # latent codes的优化方式, 冻结codes的阶段只优化alpha(channel importance), 见code_frozen()
+        self.code_schedule = getattr(args, 'code_schedule', 'Joint')
+        self.code_phase = max(getattr(args, 'code_phase', 500), 1)
+        if self.code_schedule not in ['Joint', 'Refine', 'Alternate']:
+            raise ValueError('Unsupported code schedule `%s`!' % self.code_schedule)
+        # alpha的L1稀疏正则, 以及定期剪掉不重要的latent codes, 见prune_codes()
+        self.alpha_l1 = getattr(args, 'alpha_l1', 0.)
+        self.prune_every = getattr(args, 'prune_every', 0)
+        self.prune_threshold = getattr(args, 'prune_threshold', 0.1)
+        self.min_codes = max(getattr(args, 'min_codes', 1), 1)
+
+    # 第step步是否冻结latent codes
+    # 'Joint': 始终同时优化codes和alpha
+    # 'Refine': 前code_phase步同时优化, 之后只优化alpha
+    # 'Alternate': 同时优化和只优化alpha, 每code_phase步交替一次
+    def code_frozen(self, step):
+        if self.code_schedule == 'Refine':
+            return step >= self.code_phase
+        elif self.code_schedule == 'Alternate':
+            return (step // self.code_phase) % 2 == 1
+        return False
+
+    # 注册每次迭代的回调, 见inversion/hooks.py
+    def register_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
 
     # 逆映射,生成图像
     # latent_estimates, history = inversion.invert(generator, y_gt, loss, batch_size=1, video=args.video)
-    def invert(self, generator, gt_image, loss_function, batch_size=1, video=False, *init):
+    def invert(self, generator, gt_image, loss_function, batch_size=1, video=False, *init, checkpoint_path=None):
+        # 在开始优化之前检查, 避免优化到一半才出错
+        if self.code_schedule != 'Joint' and not hasattr(generator, 'freeze_codes'):
+            raise ValueError('Code schedule `%s` needs a multi-code generator!' % self.code_schedule)
+        if self.prune_every > 0 and not getattr(generator, 'can_prune_codes', False):
+            raise ValueError('Pruning latent codes is not supported by `%s`!' % type(generator).__name__)
         input_size_list = generator.input_size()    #  def input_size(self):
                                                         #return [(self.z_number, self.z_dim), (self.z_number, self.layer_c_number)]
         if len(init) == 0:
@@ -31,36 +72,127 @@ class GradientDescent(object):
                 latent_estimate = []
                 for input_size in input_size_list:
                     if self.init_type == 'Zero':
-                        latent_estimate.append(torch.zeros((batch_size,) + input_size).cuda())
+                        latent_estimate.append(torch.zeros((batch_size,) + input_size, device=gt_image.device))
                         # latent_estimate尺寸为：A(batch_size, self.z_number, slef.z_dim)和 B(batch_size, self.z_number, slef.layer_c_number)
                         # layer_c_number的值为分割的那一层的z_dim， 默认的z_dim为512
                         # A是用来生成预计结果的，B是生成alpha的， 即加权矩阵
                     elif self.init_type == 'Normal':
-                        latent_estimate.append(torch.randn((batch_size,) + input_size).cuda())
+                        latent_estimate.append(torch.randn((batch_size,) + input_size, device=gt_image.device))
             else:
                 # generator.init_value()方法和上面初始化的方式一样，都是随机生成预计结果和alpha的
-                latent_estimate = list(generator.init_value(batch_size))    # 随机初始化estimate： return [z_estimate, z_alpha]
+                latent_estimate = list(generator.init_value(batch_size, device=gt_image.device))    # 随机初始化estimate： return [z_estimate, z_alpha]
         else:
             assert len(init) == len(input_size_list), 'Please check the number of init value'
-            latent_estimate = init
+            latent_estimate = list(init)
 
         for latent in latent_estimate:
             latent.requires_grad = True
         # 将z_estimate和z_alpha放入优化器迭代优化
         optimizer = self.optimizer(latent_estimate, lr=self.lr)
+        # 学习率调度器, 每次optimizer.step()之后更新学习率
+        scheduler, schedule = get_lr_scheduler(optimizer, self.args)
+        print('Learning rate: %s, %s' % (self.lr, schedule))
 
         history = []
+        # 没有hooks时不记录loss, 不产生额外开销
+        # 否则loss先写入预分配在设备上的tensor, 每log_every步才拷贝回内存一次, 避免每步.item()引起的同步
+        hooks = list(self.hooks)
+        loss_buffer = torch.zeros(self.iterations, device=gt_image.device) if hooks else None
+        flushed = 0
+        for hook in hooks:
+            hook.on_begin(latent_estimate)
         # Opt
         # tqdm是一个便捷的进度条封装器, 可以封装任意的迭代器以在终端显示进度条
-        for i in tqdm(range(self.iterations)):
+        frozen = False
+        pbar = tqdm(range(self.iterations))
+        for i in pbar:
+            if self.code_frozen(i) != frozen:
+                frozen = not frozen
+                if frozen:      # 缓存各个code的feature map, codes没有梯度, 优化器不会更新它们
+                    generator.freeze_codes(latent_estimate)
+                    for j, latent in enumerate(latent_estimate):
+                        if j != 1:
+                            latent.grad = None
+                else:
+                    generator.unfreeze_codes()
             y_estimate = generator(latent_estimate)  # 使用latent code合成图像，generator是加载的预训练model
             optimizer.zero_grad()       # 优化器清除缓存
             # 用神经网络生成的图像与输入计算loss，反过来优化latent_estimate，
             # 最后返回的不是网络生成的y_estimate，而是latent_estimate
             loss = loss_function(y_estimate, gt_image)  # 计算loss
+            if self.alpha_l1 > 0 and len(latent_estimate) > 1:
+                loss = loss + self.alpha_l1 * latent_estimate[1].abs().mean()
             loss.backward()         # 梯度值回溯
             optimizer.step()        # 优化
+            scheduler.step()        # 更新学习率
+            if schedule.scheduler_type != 'None' or schedule.warmup > 0:
+                pbar.set_postfix(lr='%.4g' % optimizer.param_groups[0]['lr'], refresh=False)
             if video:
                 history.append(copy.deepcopy(latent_estimate))
+            if hooks:
+                loss_buffer[i] = loss.detach()
+                for hook in hooks:
+                    hook.on_step(i, loss_buffer[i])
+                if (i + 1) % self.log_every == 0 or i + 1 == self.iterations:
+                    losses = loss_buffer[flushed:i + 1].cpu()
+                    flushed = i + 1
+                    for hook in hooks:
+                        hook.on_checkpoint(i + 1, losses)
+            if checkpoint_path is not None and self.checkpoint_every > 0 and (i + 1) % self.checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path, i + 1, latent_estimate, optimizer, scheduler, schedule)
+            if self.prune_every > 0 and (i + 1) % self.prune_every == 0 and i + 1 < self.iterations:
+                self.prune_codes(generator, latent_estimate, optimizer)
+        if frozen:
+            generator.unfreeze_codes()
+        if checkpoint_path is not None:
+            self.save_checkpoint(checkpoint_path, self.iterations, latent_estimate, optimizer, scheduler, schedule)
+        if hooks:
+            losses = loss_buffer.cpu()
+            for hook in hooks:
+                hook.on_end(latent_estimate, losses)
         return latent_estimate, history
 
+    # 剪掉channel importance(alpha的平均绝对值)低于prune_threshold * 所有codes平均值的latent codes
+    # batch中的图片共用同一组codes的序号, 只剪掉对每张图片都不重要的codes
+    # 被剪掉的codes同时从latent_estimate和优化器的状态中删除, 之后每次迭代pre_model的计算量和显存随之减少
+    def prune_codes(self, generator, latent_estimate, optimizer):
+        z_estimate, alpha_estimate = latent_estimate[0], latent_estimate[1]
+        code_number = alpha_estimate.size()[1]
+        importance = alpha_estimate.detach().abs().mean(dim=2).max(dim=0)[0]
+        keep = importance >= self.prune_threshold * importance.mean()
+        if keep.sum().item() < self.min_codes:
+            keep[importance.argsort(descending=True)[:self.min_codes]] = True
+        if keep.all():
+            return
+        keep_index = keep.nonzero().view(-1)
+        new_number = keep_index.numel()
+        generator.prune_codes(keep_index)
+        # 融合时除以codes的数量, 剪枝后除数变小, 融合结果已经放大了code_number / new_number倍
+        # 剩余的alpha按new_number / code_number缩小, 使得剪枝前后的feature map(被剪掉的codes不重要)和生成的图像连续
+        scale = new_number / code_number
+        new_latents = [z_estimate.detach()[:, keep_index].clone(),
+                       alpha_estimate.detach()[:, keep_index] * scale]
+        # 除数变小后, loss对缩小后的alpha的梯度放大了code_number / new_number倍(即1 / scale)
+        # 优化器的动量按梯度的变化缩放(二阶矩按平方缩放), 使之与剪枝后的梯度一致
+        for old, new, factor in zip([z_estimate, alpha_estimate], new_latents, [1., 1. / scale]):
+            new.requires_grad = True
+            state = optimizer.state.pop(old, {})
+            for key, value in state.items():
+                if torch.is_tensor(value) and value.size() == old.size():
+                    state[key] = value[:, keep_index] * (factor ** 2 if key.endswith('exp_avg_sq') else factor)
+            if state:
+                optimizer.state[new] = state
+            for group in optimizer.param_groups:
+                group['params'] = [new if p is old else p for p in group['params']]
+        latent_estimate[0], latent_estimate[1] = new_latents
+
+    # 保存当前的优化状态, 包括学习率调度的设置, 以便复现或继续优化
+    def save_checkpoint(self, path, step, latent_estimate, optimizer, scheduler, schedule):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save({'step': step,
+                    'latent_estimate': [latent.detach().cpu() for latent in latent_estimate],
+                    'optimizer': optimizer.state_dict(),
+                    'lr': self.lr,
+                    'lr_schedule': schedule.describe(),
+                    'lr_scheduler': scheduler.state_dict()}, path)
+
@@ -1,44 +1,117 @@
+import os
+import time
+import weakref
+import zlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchvision.models.vgg import vgg16, vgg19
 
 # 获取目标函数, 或者叫损失函数
 # 用来计算结果与预期的误差以进行调优
 def get_loss(loss_name, args):
     if loss_name == 'VGG':
-        return VGGLoss(args.vgg_layer, args)
+        return get_perceptual_loss(args)
     elif loss_name == 'L1':
         return nn.L1Loss(reduction='mean')
     elif loss_name == 'L2':             # L2 loss 也叫MSE loss, 均方差（Mean Squared Error，MSE）损失.
         return nn.MSELoss(reduction='mean')
     elif loss_name == 'Combine':
         return CombinationLoss(args)
+    elif loss_name == 'Light':          # 轻量的感知误差, 适合CPU
+        return LightVGGLoss(args)
+    elif loss_name == 'CombineLight':   # L2 + 轻量的感知误差
+        return CombinationLoss(args, perceptual=LightVGGLoss(args))
+    else:
+        raise ValueError('Unsupported loss type `%s`!' % loss_name)
 
 # 使用perceptual Loss + MSE
 class CombinationLoss(nn.Module):
-    def __init__(self, args):
+    """
+    l1_lambda * L1 + l2_lambda * L2 + vgg_lambda * perceptual loss.
+    Terms with zero weight are dropped at construction (the VGG trunk is not even built when vgg_lambda is 0), and
+    the pixel terms share one residual `x - gt`. With `args.debug`, the time of every term is accumulated until
+    `reset_timings()`, see `timing_report()`.
+    """
+    def __init__(self, args, perceptual=None):
         super(CombinationLoss, self).__init__()
         self.l1_lambda = args.l1_lambda
         self.l2_lambda = args.l2_lambda
         self.vgg_lambda = args.vgg_lambda
-        self.vgg = VGGLoss(args.vgg_layer, args)
-        self.mse = nn.MSELoss()
-        self.l1 = nn.L1Loss()
+        self.debug = getattr(args, 'debug', False)
+        # 像素误差项: (名称, 权重, 以residual为输入的函数)
+        self.pixel_terms = []
+        if self.l1_lambda != 0:
+            self.pixel_terms.append(('l1', self.l1_lambda, lambda residual: residual.abs().mean()))
+        if self.l2_lambda != 0:
+            self.pixel_terms.append(('l2', self.l2_lambda, lambda residual: residual.pow(2).mean()))
+        if self.vgg_lambda != 0:
+            self.vgg = perceptual if perceptual is not None else get_perceptual_loss(args)
+        else:
+            self.vgg = None
+        if len(self.pixel_terms) == 0 and self.vgg is None:
+            raise ValueError('All the weights of CombinationLoss are zero!')
+        self.timings = {}
 
     def cuda(self, device=None):
-        self.l1.cuda()
-        self.mse.cuda()
-        self.vgg.cuda()
+        if self.vgg is not None:
+            self.vgg.cuda(device=device)
+
+    def _timed(self, name, fn, *inputs):
+        if not self.debug:
+            return fn(*inputs)
+        # 计时需要同步设备, 只在debug模式下进行
+        cuda = inputs[0].is_cuda
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        value = fn(*inputs)
+        if cuda:
+            torch.cuda.synchronize()
+        total, count = self.timings.get(name, (0., 0))
+        self.timings[name] = (total + time.perf_counter() - start, count + 1)
+        return value
+
+    def reset_timings(self):
+        self.timings = {}
+
+    def timing_report(self, reset=False):
+        """
+        :param reset: clear the timings after the report, so the next report only covers the following calls
+            (e.g. the next image when the loss is reused across images)
+        :return: the mean time of every term since the construction or the last reset
+        """
+        report = ', '.join('%s: %.3f ms' % (name, 1000 * total / count)
+                           for name, (total, count) in self.timings.items())
+        if reset:
+            self.reset_timings()
+        return report
 
     def forward(self, x, gt):
-        l1 = self.l1(x, gt)
-        l2 = self.mse(x, gt)
-        vgg = self.vgg(x, gt)
-        # print(l1.item(), l2.item(), vgg.item())
-        return self.l1_lambda * l1 + \
-               self.l2_lambda * l2 + \
-               self.vgg_lambda * vgg
+        loss = 0.
+        if self.pixel_terms:
+            residual = self._timed('residual', torch.sub, x, gt)
+            for name, weight, term in self.pixel_terms:
+                loss = loss + weight * self._timed(name, term, residual)
+        if self.vgg is not None:
+            loss = loss + self.vgg_lambda * self._timed('vgg', self.vgg, x, gt)
+        return loss
+
+
+# 感知误差: 设置了vgg_layers时使用多层特征, 否则使用单层vgg_layer
+def get_perceptual_loss(args):
+    vgg_layers = parse_number_list(getattr(args, 'vgg_layers', ''), int)
+    if len(vgg_layers) == 0:
+        return VGGLoss(args.vgg_layer, args)
+    layer_weights = parse_number_list(getattr(args, 'vgg_layer_weights', ''), float)
+    return MultiLayerVGGLoss(vgg_layers, layer_weights, args)
+
+
+# 解析命令行中逗号分隔的数字, 如 '4,9,16'
+def parse_number_list(value, number_type=int):
+    if isinstance(value, (list, tuple)):
+        return [number_type(v) for v in value]
+    return [number_type(v) for v in str(value).split(',') if v.strip()]
 
 
 class VGGLoss(nn.Module):
@@ -77,19 +150,15 @@ class VGGLoss(nn.Module):
     """
     def __init__(self, vgg_layer, args):
         super(VGGLoss, self).__init__()
-        self.vgg = nn.Sequential(*list(vgg16(pretrained=True).children())[0][:vgg_layer])
+        # 输入的预处理(值域映射+归一化)和resize已经合并进了VGG网络
+        self.vgg = build_perceptual_net(vgg_layer, args.image_size, getattr(args, 'vgg_resize', 'nearest'))
         if args.vgg_loss_type == 'L2':
             self.loss = F.mse_loss
         elif args.vgg_loss_type == 'L1':
             self.loss = F.l1_loss
-        self.pre_processing_mean = torch.Tensor([0.485, 0.456, 0.406])
-        self.pre_processing_std = torch.Tensor([0.229, 0.224, 0.225])
-        self.resize = args.image_size
 
     def cuda(self, device=None):
         self.vgg.cuda(device=device)
-        self.pre_processing_mean = self.pre_processing_mean.cuda(device=device)
-        self.pre_processing_std = self.pre_processing_std.cuda(device=device)
 
     def forward(self, x, gt):
         """
@@ -97,9 +166,240 @@ class VGGLoss(nn.Module):
         :param gt: [-1.0, 1.0]
         :return:
         """
-        x = (x * 0.5 + 0.5).sub_(self.pre_processing_mean[:, None, None]).div_(self.pre_processing_std[:, None, None])
-        gt = (gt * 0.5 + 0.5).sub_(self.pre_processing_mean[:, None, None]).div_(self.pre_processing_std[:, None, None])
-        x_features = self.vgg(F.interpolate(x, size=self.resize, mode='nearest'))
-        gt_features = self.vgg(F.interpolate(gt, size=self.resize, mode='nearest'))
+        x_features = self.vgg(x)
+        gt_features = self.vgg(gt)
         return self.loss(x_features, gt_features, reduction='mean') * 0.001
 
+
+class MultiLayerVGGLoss(nn.Module):
+    """
+    Perceptual loss on several layers of one VGG16 trunk.
+    The trunk is truncated at the deepest requested layer, and the other layers are tapped with forward hooks,
+    so one partial VGG forward gives all the features. Layer `l` means the output of `vgg16().features[:l]`,
+    the same as `vgg_layer` of VGGLoss.
+    The features of the target image are computed once and reused until another target (or an in-place modified
+    one) is given.
+    """
+    def __init__(self, vgg_layers, layer_weights, args):
+        super(MultiLayerVGGLoss, self).__init__()
+        if len(layer_weights) == 0:
+            layer_weights = [1.] * len(vgg_layers)
+        if len(layer_weights) != len(vgg_layers):
+            raise ValueError('`vgg_layer_weights` should have the same length as `vgg_layers`!')
+        if min(vgg_layers) < 2:
+            raise ValueError('Layers used in perceptual loss should be no less than 2, but %s received.' % vgg_layers)
+        self.vgg_layers = list(vgg_layers)
+        self.layer_weights = list(layer_weights)
+        self.vgg = build_perceptual_net(max(vgg_layers), args.image_size, getattr(args, 'vgg_resize', 'nearest'))
+        if args.vgg_loss_type == 'L2':
+            self.loss = F.mse_loss
+        elif args.vgg_loss_type == 'L1':
+            self.loss = F.l1_loss
+
+        # PerceptualNet.features从VGG的第1层开始, 第l层的输出即features[l - 2]的输出
+        self._features = {}
+        for layer in sorted(set(self.vgg_layers)):
+            module_index = layer - 2
+            self.vgg.features[module_index].register_forward_hook(self._save_hook(layer))
+            # 后面紧跟的inplace ReLU会修改被记录的输出
+            if module_index + 1 < len(self.vgg.features) and \
+                    isinstance(self.vgg.features[module_index + 1], nn.ReLU):
+                self.vgg.features[module_index + 1].inplace = False
+        self._gt_ref = None
+        self._gt_version = None
+        self._gt_features = None
+
+    def _save_hook(self, layer):
+        def hook(module, inputs, output):
+            self._features[layer] = output
+        return hook
+
+    def cuda(self, device=None):
+        self.vgg.cuda(device=device)
+        self._gt_ref = None
+
+    def extract(self, x):
+        self._features = {}
+        self.vgg(x)
+        features = [self._features[layer] for layer in self.vgg_layers]
+        self._features = {}
+        return features
+
+    def target_features(self, gt):
+        if self._gt_ref is None or self._gt_ref() is not gt or self._gt_version != gt._version:
+            with torch.no_grad():
+                self._gt_features = self.extract(gt)
+            self._gt_ref = weakref.ref(gt)
+            self._gt_version = gt._version
+        return self._gt_features
+
+    def forward(self, x, gt):
+        """
+        :param x: [-1.0, 1.0]
+        :param gt: [-1.0, 1.0]
+        :return:
+        """
+        gt_features = self.target_features(gt)
+        x_features = self.extract(x)
+        loss = 0.
+        for weight, x_feature, gt_feature in zip(self.layer_weights, x_features, gt_features):
+            loss = loss + weight * self.loss(x_feature, gt_feature, reduction='mean')
+        return loss * 0.001
+
+
+class LightVGGLoss(VGGLoss):
+    """
+    Perceptual loss on a channel pruned VGG16 trunk, much cheaper than VGGLoss on CPU.
+    Only the first `light_vgg_layer` layers (default 9, i.e. the first two blocks) are kept, and every conv keeps
+    `light_channel_ratio` of its filters, the ones with the largest L1 norm.
+    """
+    def __init__(self, args):
+        nn.Module.__init__(self)
+        self.vgg = build_light_perceptual_net(getattr(args, 'light_vgg_layer', 9),
+                                              getattr(args, 'light_channel_ratio', 0.5),
+                                              args.image_size, getattr(args, 'vgg_resize', 'nearest'))
+        if args.vgg_loss_type == 'L2':
+            self.loss = F.mse_loss
+        elif args.vgg_loss_type == 'L1':
+            self.loss = F.l1_loss
+
+
+def build_light_perceptual_net(vgg_layer, channel_ratio, image_size, resize_mode='nearest'):
+    """
+    Build a channel pruned VGG16 trunk for the perceptual loss.
+    :param vgg_layer: number of layers of `vgg16().features` to keep
+    :param channel_ratio: ratio of output channels kept in every conv, (0, 1]
+    :param image_size: size of the images fed into VGG
+    :param resize_mode: see `build_perceptual_net`
+    :return: PerceptualNet
+    """
+    if not 0. < channel_ratio <= 1.:
+        raise ValueError('`channel_ratio` should be in (0, 1], but %s received.' % channel_ratio)
+    vgg = load_vgg16_features()[:vgg_layer]
+    layers = []
+    kept = None     # 上一个conv保留的输出channel, 对应这一个conv的输入channel
+    for layer in vgg:
+        if isinstance(layer, nn.Conv2d):
+            weight = layer.weight.detach()
+            if kept is not None:
+                weight = weight[:, kept]
+            # 按卷积核的L1范数保留最重要的channel
+            keep_number = max(int(round(layer.out_channels * channel_ratio)), 1)
+            kept = weight.abs().sum(dim=(1, 2, 3)).argsort(descending=True)[:keep_number].sort()[0]
+            pruned = nn.Conv2d(weight.size()[1], keep_number, kernel_size=layer.kernel_size, stride=layer.stride,
+                               padding=layer.padding, dilation=layer.dilation, bias=layer.bias is not None)
+            pruned.weight.data.copy_(weight[kept])
+            if layer.bias is not None:
+                pruned.bias.data.copy_(layer.bias.detach()[kept])
+            layers.append(pruned)
+        else:
+            layers.append(layer)
+    return PerceptualNet(nn.Sequential(*layers), image_size, resize_mode)
+
+
+# ImageNet的均值和方差, VGG的输入需要用其归一化
+VGG_MEAN = [0.485, 0.456, 0.406]
+VGG_STD = [0.229, 0.224, 0.225]
+
+
+def build_perceptual_net(vgg_layer, image_size, resize_mode='nearest'):
+    """
+    Build the VGG16 trunk (truncated at `vgg_layer`) used by the perceptual loss, with the input pre-processing
+    folded into the network.
+    :param vgg_layer: number of layers of `vgg16().features` to keep
+    :param image_size: size of the images fed into VGG
+    :param resize_mode: 'nearest' is equivalent to the original pre-processing, 'area' averages the pixels
+    :return: PerceptualNet, which takes images in [-1.0, 1.0]
+    """
+    vgg = nn.Sequential(*load_vgg16_features()[:vgg_layer])
+    return PerceptualNet(vgg, image_size, resize_mode)
+
+
+# torchvision缓存的VGG16预训练权重
+VGG16_WEIGHT_FILE = 'vgg16-397923af.pth'
+
+
+def load_vgg16_features():
+    """
+    Convolutional part of the pretrained VGG16.
+    In fixture mode (`Model_Settings.FIXTURE_MODE`) and without the pretrained weights cached locally,
+    the weights are random with a fixed seed instead, so nothing is downloaded.
+    """
+    from torchvision.models.vgg import vgg16     # 推迟导入, 只在构建感知loss时需要
+    import GAN.Model_Settings as Model_Settings
+    cached = os.path.isfile(os.path.join(torch.hub.get_dir(), 'checkpoints', VGG16_WEIGHT_FILE))
+    if Model_Settings.FIXTURE_MODE and not cached:
+        with torch.random.fork_rng(devices=[]):     # 不影响全局的随机数状态
+            torch.manual_seed(zlib.crc32(b'vgg16'))
+            return list(vgg16(pretrained=False).children())[0]
+    return list(vgg16(pretrained=True).children())[0]
+
+
+class PerceptualNet(nn.Module):
+    """
+    Equals to
+        x = (x * 0.5 + 0.5 - mean) / std
+        vgg(F.interpolate(x, size=image_size, mode='nearest'))
+    but without any full resolution temporary.
+    (1) Nearest resize commutes with the per-channel affine normalization, so it is done first on the raw input.
+        An integer downsampling factor is a strided slice, and the resize is skipped if the size already matches.
+    (2) The normalization x * a + b is folded into the first conv: the weight is scaled by a, and b contributes a
+        bias map, which is constant inside the image but differs at the zero padded border. The bias map only
+        depends on the input size, so it is computed once and cached.
+    """
+    def __init__(self, vgg, image_size, resize_mode='nearest'):
+        super(PerceptualNet, self).__init__()
+        if resize_mode not in ['nearest', 'area']:
+            raise ValueError('Unsupported resize mode `%s` of perceptual network.' % resize_mode)
+        first_conv = vgg[0]
+        assert isinstance(first_conv, nn.Conv2d) and first_conv.in_channels == len(VGG_MEAN)
+        mean = torch.Tensor(VGG_MEAN)
+        std = torch.Tensor(VGG_STD)
+        scale = (0.5 / std).view(1, -1, 1, 1)
+        shift = ((0.5 - mean) / std).view(1, -1, 1, 1)
+        weight = first_conv.weight.detach()
+        bias = first_conv.bias.detach() if first_conv.bias is not None else torch.zeros(first_conv.out_channels)
+        self.register_buffer('weight', weight * scale)
+        self.register_buffer('bias', bias.clone())
+        # 常数输入shift经过卷积的结果: 对各个channel求和后只需要用单通道的全1图像卷积一次
+        self.register_buffer('shift_weight', (weight * shift).sum(dim=1, keepdim=True))
+        self.stride = first_conv.stride
+        self.padding = first_conv.padding
+        self.dilation = first_conv.dilation
+        self.features = vgg[1:]
+        self.image_size = image_size
+        self.resize_mode = resize_mode
+        self._bias_maps = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        self._bias_maps = {}    # 移动设备或者改变类型后重新计算
+        return super(PerceptualNet, self)._apply(fn, *args, **kwargs)
+
+    def resize(self, x):
+        height, width = x.size()[2], x.size()[3]
+        size = self.image_size
+        if height == size and width == size:
+            return x
+        if self.resize_mode == 'area':
+            return F.adaptive_avg_pool2d(x, size)
+        if height % size == 0 and width % size == 0:    # 整数倍的nearest下采样即为间隔采样
+            return x[:, :, ::height // size, ::width // size]
+        return F.interpolate(x, size=size, mode='nearest')
+
+    def bias_map(self, x):
+        key = (x.size()[2], x.size()[3], x.device, x.dtype)
+        if key not in self._bias_maps:
+            with torch.no_grad():
+                ones = torch.ones((1, 1) + key[:2], device=x.device, dtype=x.dtype)
+                self._bias_maps[key] = F.conv2d(ones, self.shift_weight, self.bias, self.stride, self.padding,
+                                                self.dilation)
+        return self._bias_maps[key]
+
+    def forward(self, x):
+        """
+        :param x: [-1.0, 1.0]
+        :return: VGG features
+        """
+        x = self.resize(x)
+        x = F.conv2d(x, self.weight, None, self.stride, self.padding, self.dilation) + self.bias_map(x)
+        return self.features(x)
@@ -0,0 +1,87 @@
+import math
+
+from torch.optim.lr_scheduler import LambdaLR
+
+
+# 学习率调度器
+# 所有调度方式都表示为"第t步的学习率系数", 统一由LambdaLR驱动, 方便记录到日志和checkpoint中
+def get_lr_scheduler(optimizer, args):
+    schedule = LRSchedule(scheduler_type=getattr(args, 'lr_scheduler', 'None'),
+                          iterations=args.iterations,
+                          warmup=getattr(args, 'lr_warmup', 0),
+                          step_size=getattr(args, 'lr_step_size', 1000),
+                          gamma=getattr(args, 'lr_gamma', 0.5),
+                          min_ratio=getattr(args, 'lr_min_ratio', 0.),
+                          restart_period=getattr(args, 'lr_restart_period', 500),
+                          restart_mult=getattr(args, 'lr_restart_mult', 1))
+    return LambdaLR(optimizer, lr_lambda=schedule), schedule
+
+
+class LRSchedule(object):
+    """
+    Learning rate factor of step t (multiplied with the initial `lr`).
+    'None': constant
+    'Warmup': linear warmup for `warmup` steps, then constant
+    'Step': multiplied by `gamma` every `step_size` steps
+    'Exponential': multiplied by `gamma` every step
+    'Cosine': cosine annealing from 1 to `min_ratio` over all iterations
+    'CosineRestart': cosine annealing with warm restarts (SGDR), the first period is `restart_period`
+        and every following period is `restart_mult` times longer
+    A linear warmup of `warmup` steps can be put in front of every schedule.
+    """
+    SCHEDULER_TYPES = ['None', 'Warmup', 'Step', 'Exponential', 'Cosine', 'CosineRestart']
+
+    def __init__(self, scheduler_type='None', iterations=1, warmup=0, step_size=1000, gamma=0.5,
+                 min_ratio=0., restart_period=500, restart_mult=1):
+        if scheduler_type not in self.SCHEDULER_TYPES:
+            raise ValueError('Unsupported lr scheduler `%s`, please choose from %s.'
+                             % (scheduler_type, self.SCHEDULER_TYPES))
+        if scheduler_type == 'Warmup' and warmup <= 0:
+            raise ValueError("'Warmup' lr scheduler needs `lr_warmup` > 0.")
+        self.scheduler_type = scheduler_type
+        self.iterations = max(int(iterations), 1)
+        self.warmup = max(int(warmup), 0)
+        self.step_size = max(int(step_size), 1)
+        self.gamma = gamma
+        self.min_ratio = min_ratio
+        self.restart_period = max(int(restart_period), 1)
+        self.restart_mult = max(int(restart_mult), 1)
+
+    def _cosine(self, t, period):
+        return self.min_ratio + (1. - self.min_ratio) * 0.5 * (1. + math.cos(math.pi * t / period))
+
+    def __call__(self, step):
+        if step < self.warmup:
+            return (step + 1) / self.warmup
+        # warmup之后重新从0开始计数
+        t = step - self.warmup
+        if self.scheduler_type in ['None', 'Warmup']:
+            return 1.
+        elif self.scheduler_type == 'Step':
+            return self.gamma ** (t // self.step_size)
+        elif self.scheduler_type == 'Exponential':
+            return self.gamma ** t
+        elif self.scheduler_type == 'Cosine':
+            return self._cosine(min(t, self.iterations - self.warmup), max(self.iterations - self.warmup, 1))
+        elif self.scheduler_type == 'CosineRestart':
+            period = self.restart_period
+            while t >= period:      # 找到当前所在的重启周期
+                t -= period
+                period *= self.restart_mult
+            return self._cosine(t, period)
+
+    def describe(self):
+        """
+        :return: dict of the schedule settings, saved into logs and checkpoints
+        """
+        return {'scheduler_type': self.scheduler_type,
+                'iterations': self.iterations,
+                'warmup': self.warmup,
+                'step_size': self.step_size,
+                'gamma': self.gamma,
+                'min_ratio': self.min_ratio,
+                'restart_period': self.restart_period,
+                'restart_mult': self.restart_mult}
+
+    def __repr__(self):
+        return 'LRSchedule(%s)' % ', '.join('%s=%s' % (k, v) for k, v in self.describe().items())
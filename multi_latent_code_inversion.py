@@ -1,15 +1,17 @@
 import torch
 import argparse
-import cv2
 import os
 
 from Derivable_Models.Derivable_Generator import get_derivable_generator
 from inversion.losses import get_loss
 from inversion.inversion_methods import get_inversion
+from inversion.hooks import LossLogger, StepTimer
+from utils.layer_profiler import LayerProfiler
 from utils.file_utils import image_files,  load_as_tensor, Tensor2PIL, split_to_batches
 from GAN.Model_Settings import MODEL_POOL
+from GAN.memory_probe import inversion_batch_size
 from utils.image_precossing import _sigmoid_to_tanh, _tanh_to_sigmoid, _add_batch_one
-from utils.manipulate import convert_array_to_images
+from utils.manipulate import convert_tensor_to_images
 
 # 超参
 # 加载的模型名称
@@ -22,8 +24,6 @@ output_pth='./inversion_output'
 learning_rate = 1.
 # 迭代次数
 iterations = 3000
-# batch size
-BATCH_SIZE = 1
 
 def run(args):
     os.makedirs(args.outputs,exist_ok=True) # 生成输出路径文件夹，存在则跳过
@@ -33,14 +33,23 @@ def run(args):
     generator.cuda()    # pytorch需要手动放入GPU进行运算
     loss.cuda()
     inversion = get_inversion(args.optimization, args)
+    if args.report_performance:
+        inversion.register_hook(StepTimer())
     image_list = image_files(args.target_images)        # 获取输入图片路径
     frameSize = MODEL_POOL[args.gan_model]['resolution']        # 获取图像分辨率
+    if args.batch_size == 0:      # 以第一张图片为目标, 测量每张图片反演一步的峰值显存, 按内存预算自动选择
+        target = _sigmoid_to_tanh(_add_batch_one(load_as_tensor(image_list[0])))
+        args.batch_size = inversion_batch_size(generator, loss, target, args, 'cuda', max_batch_size=len(image_list))
+        if hasattr(loss, 'reset_timings'):     # 测量batch大小时的运行不计入loss的耗时
+            loss.reset_timings()
+    profiler = None
+    if getattr(args, 'profile', False):      # 逐层统计耗时/FLOPs/激活内存
+        profiler = LayerProfiler().attach_generator(generator).attach_loss(loss)
 
     # 按照batch大小分批处理图像
-    for i, images in enumerate(split_to_batches(image_list, 1)):
-        print('%d: Inverting %d images :' % (i + 1, 1), end='')
-        # pt_image_str = '%s\n'
-        print('%s\n' % tuple(images))
+    for i, images in enumerate(split_to_batches(image_list, args.batch_size)):
+        print('%d: Inverting %d images :' % (i + 1, len(images)), end='')
+        print('%s\n' % ', '.join(images))
 
         image_name_list = []
         image_tensor_list = []
@@ -53,16 +62,29 @@ def run(args):
         # out (Tensor, optional) – the output tensor.
         y_gt = _sigmoid_to_tanh(torch.cat(image_tensor_list, dim=0)).cuda() # 在维度0上连接所有的tensor并且将值域映射到[-1, 1]
         # 逆映射, 生成图像tensor
-        latent_estimates, history = inversion.invert(generator, y_gt, loss, batch_size=BATCH_SIZE, video=args.video)
+        checkpoint_path = None if args.checkpoint_dir is None else \
+            os.path.join(args.checkpoint_dir, '%s.pth' % os.path.splitext(image_name_list[0])[0])
+        if args.log_every > 0:     # 记录loss曲线
+            loss_logger = inversion.register_hook(
+                LossLogger(os.path.join(args.outputs, '%s_loss.json' % os.path.splitext(image_name_list[0])[0])))
+        latent_estimates, history = inversion.invert(generator, y_gt, loss, batch_size=y_gt.size()[0], video=args.video,
+                                                     checkpoint_path=checkpoint_path)
+        if args.log_every > 0:
+            inversion.remove_hook(loss_logger)
+        if args.debug and hasattr(loss, 'timing_report'):     # 这个batch中各项loss的平均耗时
+            print('Loss timings: %s' % loss.timing_report(reset=True))
         # 将值域从[-1,1]映射到[0,1], 使用torch.clamp()进一步保证值域在[0,1]
         y_estimate_list = torch.split(torch.clamp(_tanh_to_sigmoid(generator(latent_estimates)), min=0., max=1.).cpu(), 1, dim=0)
         # Save
         for img_id, image in enumerate(images):
+            if args.prune_every > 0:     # 剪枝后剩余的latent codes数量
+                print('%s: %d latent codes left.' % (image_name_list[img_id], latent_estimates[0].size()[1]))
             y_estimate_pil = Tensor2PIL(y_estimate_list[img_id])        # 从tensor转化为PIL image并保存
             y_estimate_pil.save(os.path.join(args.outputs, image_name_list[img_id]))
 
             # Create video
             if args.video:
+                import cv2      # 只在保存视频时需要
                 print('Create GAN-Inversion video.')
                 video = cv2.VideoWriter(
                     filename=os.path.join(args.outputs, '%s_inversion.avi' % image_name_list[img_id]),
@@ -72,9 +94,13 @@ def run(args):
                 print('Save frames.')
                 for i, sample in enumerate(history):
                     image = generator(sample)
-                    image_cv2 = convert_array_to_images(image.detach().cpu().numpy())[0][:, :, ::-1]
+                    image_cv2 = convert_tensor_to_images(image[img_id:img_id + 1])[0][:, :, ::-1]     # 只拷贝这张图片的uint8结果
                     video.write(image_cv2)
                 video.release()
+    if profiler is not None:
+        profiler.detach()
+        profiler.save(os.path.join(args.outputs, 'profile.txt'), os.path.join(args.outputs, 'profile_trace.json'))
+        print(profiler.table())
 
 if(__name__ == '__main__'):
     # 可以通过命令行输入参数
@@ -97,10 +123,37 @@ if(__name__ == '__main__'):
     # Multi-code-inversion参数
     # 默认使用multi-code反演类型
     parser.add_argument('--inversion_type', default='PGGAN-Multi-Z',
-                        help='Inversion type, "PGGAN-Multi-Z" for Multi-Code-GAN prior.')
+                        help='Inversion type, "PGGAN-Multi-Z" for Multi-Code-GAN prior, '
+                             '"PGGAN-Multi-Z-Shared" for sharing the latent codes across a batch.')
     # 层数
     parser.add_argument('--composing_layer', type=int, default=6,
                         help='Composing layer in multi-code gan inversion methods.')
+    parser.add_argument('--private_z_number', type=int, default=0,
+                        help="Used when 'inversion_type' is 'PGGAN-Multi-Z-Shared'. Number of the latent codes "
+                             "private to every image, besides the 'z_number' codes shared by the batch.")
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="Number of images inverted together. With 'PGGAN-Multi-Z-Shared' the batch shares "
+                             "one dictionary of latent codes. 0 for the largest batch fitting into the memory budget "
+                             "(see 'GAN/memory_probe.py').")
+    parser.add_argument('--code_schedule', default='Joint',
+                        help="['Joint', 'Refine', 'Alternate']. 'Refine' freezes the latent codes after 'code_phase' "
+                             "steps and only optimizes the channel importance, 'Alternate' switches between the two "
+                             "every 'code_phase' steps. Frozen codes reuse cached feature maps.")
+    parser.add_argument('--code_phase', type=int, default=500,
+                        help="Used when 'code_schedule' is 'Refine' or 'Alternate'. Number of steps of a phase.")
+    parser.add_argument('--alpha_l1', type=float, default=0.,
+                        help='Weight of the L1 sparsity regularizer on the channel importance of the latent codes.')
+    parser.add_argument('--prune_every', type=int, default=0,
+                        help='Prune the unimportant latent codes every N steps. 0 for no pruning.')
+    parser.add_argument('--prune_threshold', type=float, default=0.1,
+                        help='Codes whose mean channel importance is below threshold * the mean of all codes are pruned.')
+    parser.add_argument('--min_codes', type=int, default=1,
+                        help='Minimum number of latent codes kept by pruning.')
+    parser.add_argument('--checkpoint_blocks', type=int, default=0,
+                        help='Activation checkpointing of the generator after the composing layer, '
+                             'number of resolutions per checkpointed segment. 0 for no checkpointing.')
+    parser.add_argument('--report_performance', action='store_true',
+                        help='Report the step time and the peak memory of the optimization.')
     # 使用的latent codes的数量
     parser.add_argument('--z_number', type = int, default=30,
                         help='Number of the latent codes.')
@@ -113,11 +166,23 @@ if(__name__ == '__main__'):
     parser.add_argument('--image_size', type=int, default=256,
                         help='Size of images for perceptual model')
     parser.add_argument('--loss_type', default='Combine',
-                        help="['VGG', 'L1', 'L2', 'Combine']. 'Combine' means using L2 and Perceptual Loss.")
+                        help="['VGG', 'L1', 'L2', 'Combine', 'Light', 'CombineLight']. 'Combine' means using L2 and Perceptual Loss. "
+                             "'Light' is a channel pruned VGG for CPU.")
     parser.add_argument('--vgg_loss_type', default='L1',
                         help="['L1', 'L2']. The loss used in perceptual loss.")
     parser.add_argument('--vgg_layer', type=int, default=16,        # 计算感知误差用到的VGG卷积层层数,默认为16
                         help='The layer used in perceptual loss.')
+    parser.add_argument('--vgg_layers', default='',
+                        help="Comma separated layers used together in perceptual loss, e.g. '4,9,16,23'. "
+                             "Empty for using 'vgg_layer' only.")
+    parser.add_argument('--vgg_layer_weights', default='',
+                        help="Comma separated weights of 'vgg_layers'. Empty for equal weights.")
+    parser.add_argument('--vgg_resize', default='nearest',
+                        help="['nearest', 'area']. Resize method of the perceptual model input. 'nearest' is the original one.")
+    parser.add_argument('--light_vgg_layer', type=int, default=9,
+                        help="Used when 'loss_type' is 'Light' or 'CombineLight'. The layer of the pruned VGG.")
+    parser.add_argument('--light_channel_ratio', type=float, default=0.5,
+                        help="Used when 'loss_type' is 'Light' or 'CombineLight'. Ratio of channels kept in VGG.")
     parser.add_argument('--l1_lambda', default=0.,
                         help="Used when 'loss_type' is 'Combine'. Trade-off parameter for L1 loss.", type=float)
     parser.add_argument('--l2_lambda', default=1.,
@@ -136,6 +201,35 @@ if(__name__ == '__main__'):
     # 迭代次数
     parser.add_argument('--iterations', default=iterations,
                         help='Number of optimization steps.', type=int)
+    # 学习率调度
+    parser.add_argument('--lr_scheduler', default='None',
+                        help="['None', 'Warmup', 'Step', 'Exponential', 'Cosine', 'CosineRestart']. Learning rate schedule.")
+    parser.add_argument('--lr_warmup', type=int, default=0,
+                        help='Number of linear warmup steps in front of the learning rate schedule.')
+    parser.add_argument('--lr_step_size', type=int, default=1000,
+                        help="Used when 'lr_scheduler' is 'Step'. Decay period of learning rate.")
+    parser.add_argument('--lr_gamma', type=float, default=0.5,
+                        help="Decay factor, per 'lr_step_size' steps for 'Step' and per step for 'Exponential'.")
+    parser.add_argument('--lr_min_ratio', type=float, default=0.,
+                        help="Used when 'lr_scheduler' is 'Cosine' or 'CosineRestart'. Minimum learning rate / 'lr'.")
+    parser.add_argument('--lr_restart_period', type=int, default=500,
+                        help="Used when 'lr_scheduler' is 'CosineRestart'. Number of steps of the first period.")
+    parser.add_argument('--lr_restart_mult', type=int, default=1,
+                        help="Used when 'lr_scheduler' is 'CosineRestart'. Growth factor of the restart period.")
+    # Loss logging
+    parser.add_argument('--log_every', type=int, default=0,
+                        help='Log the loss curve, copying losses from device every N steps. 0 for no logging.')
+    # Checkpoint
+    parser.add_argument('--checkpoint_dir', default=None,
+                        help='Directory to save optimization checkpoints. None for no checkpoint.')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='Save a checkpoint every N steps. 0 for saving the final state only.')
+
+    parser.add_argument('--debug', action='store_true',
+                        help='Report the time of every loss term. Slower, as the device is synchronized.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the time, FLOPs and activation memory of every generator and VGG layer, '
+                             "saved to 'profile.txt' and the Chrome trace 'profile_trace.json' in 'outputs'.")
 
     # Video Settings
     parser.add_argument('--video', type=bool, default=True, help='Save video. False for no video.')
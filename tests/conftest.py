@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+
+import pytest
+
+# 测试使用固件模型, 不需要预训练权重, 可以离线运行
+os.environ.setdefault('MGAN_FIXTURE_MODE', '1')
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
+
+import GAN.Model_Settings as Model_Settings
+
+Model_Settings.FIXTURE_MODE = True
+Model_Settings.USE_CUDA = False
+
+from Derivable_Models.Gan_Utils import build_generator
+
+
+# 各个测试共用的命令行参数, 测试只需要给出与默认值不同的参数
+DEFAULT_ARGS = {'iterations': 10, 'lr': 1e-7, 'init_type': 'Normal', 'composing_layer': 2, 'z_number': 4,
+                'checkpoint_blocks': 0, 'l1_lambda': 0., 'l2_lambda': 1., 'vgg_lambda': 0., 'debug': False}
+
+
+@pytest.fixture
+def make_args():
+    def make(**kwargs):
+        args = argparse.Namespace(**DEFAULT_ARGS)
+        vars(args).update(kwargs)
+        return args
+    return make
+
+
+# 合成测试使用的小模型
+@pytest.fixture(scope='module')
+def generator():
+    generator = build_generator('pggan_fixture32')
+    generator.batch_size = 4
+    return generator
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from Derivable_Models.Gan_Utils import GENERATOR_REGISTRY
+from GAN.flat_weights import bind_flat, load_flat, save_flat
+from GAN.pggan_generator_network import PGGANGeneratorNet
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'weights.flat')
+    state_dict = {'weight': torch.randn(3, 5, 7),
+                  'half': torch.randn(9).half(),
+                  'step': torch.tensor(3),
+                  'index': torch.arange(11),
+                  'transposed': torch.randn(4, 6).t()}
+    save_flat(state_dict, path)
+    tensors = load_flat(path)
+    assert list(tensors) == list(state_dict)
+    for name, tensor in state_dict.items():
+        assert tensors[name].dtype == tensor.dtype
+        assert torch.equal(tensors[name], tensor)
+
+    # 写时复制, 修改映射的tensor不会改变文件
+    tensors['weight'].zero_()
+    assert torch.equal(load_flat(path)['weight'], state_dict['weight'])
+
+
+def test_bind_matches_generator(tmp_path):
+    path = str(tmp_path / 'pggan_fixture32.flat')
+    source = GENERATOR_REGISTRY.get('pggan_fixture32').net
+    save_flat(source.state_dict(), path)
+    net = PGGANGeneratorNet(resolution=32).eval()
+    bind_flat(net, path)
+    z = torch.randn(2, net.z_space_dim)
+    with torch.no_grad():
+        assert torch.equal(net(z), source(z))
+
+    save_flat({name: tensor for name, tensor in source.state_dict().items() if name != 'lod'}, path)
+    with pytest.raises(ValueError):
+        bind_flat(PGGANGeneratorNet(resolution=32), path)
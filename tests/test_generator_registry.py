@@ -0,0 +1,32 @@
+import torch
+
+from Derivable_Models.Derivable_Generator import PGGAN_multi_z
+from Derivable_Models.Gan_Utils import GENERATOR_REGISTRY, get_gan_model
+
+
+def weight(module):
+    return next(module.parameters())
+
+
+def test_conversion_does_not_change_other_wrappers(make_args):
+    first = PGGAN_multi_z('pggan_fixture32', 4, 4, make_args())
+    second = PGGAN_multi_z('pggan_fixture32', 4, 4, make_args())
+    assert weight(first.pre_model) is weight(second.pre_model)     # 同一个模型共享权重
+
+    first.to(dtype=torch.float64)
+    assert weight(first.pre_model).dtype == torch.float64
+    assert weight(first.post_model).dtype == torch.float64
+    assert weight(second.pre_model).dtype == torch.float32
+    assert weight(get_gan_model('pggan_fixture32')).dtype == torch.float32
+    # 转换后的副本也被缓存和共享
+    assert weight(first.pre_model) is weight(get_gan_model('pggan_fixture32', dtype=torch.float64))
+    assert 'pggan_fixture32@cpu/float64' in GENERATOR_REGISTRY.stats()['models']
+
+    latents = [latent.double() for latent in first.init_value(2, device='cpu')]
+    with torch.no_grad():
+        expected = second([latent.float() for latent in latents])
+        assert torch.allclose(first(latents).float(), expected, atol=1e-5)
+
+    # 转换回原来的精度时使用原来的层
+    first.float()
+    assert weight(first.pre_model) is weight(second.pre_model)
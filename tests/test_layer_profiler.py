@@ -0,0 +1,32 @@
+import torch
+import torch.nn as nn
+
+from Derivable_Models.Derivable_Generator import PGGAN_multi_z
+from utils.layer_profiler import LayerProfiler
+
+
+def test_detach_restores_inplace_relu():
+    model = nn.Sequential(nn.Linear(4, 4), nn.ReLU(inplace=True), nn.ReLU())
+    profiler = LayerProfiler(device='cpu').attach(model, 'model')
+    assert not model[1].inplace
+    profiler.detach()
+    assert model[1].inplace and not model[2].inplace
+
+
+def test_module_called_per_code(make_args):
+    args = make_args(composing_layer=4, z_number=3)
+    generator = PGGAN_multi_z('pggan_fixture32', 4, 3, args)
+    profiler = LayerProfiler(device='cpu').attach_generator(generator)
+    latents = generator.init_value(2, device='cpu')
+    for latent in latents:
+        latent.requires_grad = True
+    start = profiler._now()
+    generator(latents).sum().backward()
+    elapsed = profiler._now() - start
+    profiler.detach()
+    stat = profiler.stats['pre_model']
+    # pre_model对每个code调用一次, 每次调用的反向传播都单独计时
+    assert stat['calls'] == stat['backward_calls'] == 3
+    assert 0 < stat['backward_s'] < elapsed
+    assert profiler.stats['post_model']['backward_calls'] == 1
+    assert not any(profiler.backward_start.values())
@@ -0,0 +1,55 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from inversion.losses import VGG_MEAN, VGG_STD, CombinationLoss, MultiLayerVGGLoss, VGGLoss, build_perceptual_net, \
+    load_vgg16_features
+
+
+def test_timing_report_reset(make_args):
+    loss = CombinationLoss(make_args(l1_lambda=1., debug=True))
+    x, gt = torch.rand(2, 3, 8, 8), torch.rand(2, 3, 8, 8)
+    for _ in range(3):
+        loss(x, gt)
+    assert loss.timings['l2'][1] == 3
+    assert 'l1' in loss.timing_report(reset=True)
+    assert loss.timings == {}
+    loss(x, gt)     # 复用loss时只统计之后的调用
+    assert loss.timings['l2'][1] == 1
+
+
+def vgg_reference(vgg, x, image_size, mode='nearest'):
+    # 折叠之前的预处理: 值域映射, 归一化, 再resize
+    mean = torch.Tensor(VGG_MEAN).view(1, -1, 1, 1)
+    std = torch.Tensor(VGG_STD).view(1, -1, 1, 1)
+    x = (x * 0.5 + 0.5 - mean) / std
+    if mode == 'area':
+        x = F.adaptive_avg_pool2d(x, image_size)
+    elif x.size()[2] != image_size:
+        x = F.interpolate(x, size=image_size, mode='nearest')
+    return vgg(x)
+
+
+@pytest.mark.parametrize('input_size,mode', [(32, 'nearest'), (64, 'nearest'), (48, 'nearest'), (64, 'area')])
+def test_folded_normalization_matches_reference(input_size, mode):
+    net = build_perceptual_net(9, 32, mode)
+    vgg = nn.Sequential(*load_vgg16_features()[:9])
+    x = torch.rand(2, 3, input_size, input_size) * 2 - 1
+    with torch.no_grad():
+        assert torch.allclose(net(x), vgg_reference(vgg, x, 32, mode), atol=1e-4)
+
+
+def test_multi_layer_loss_matches_single_layers(make_args):
+    args = make_args(image_size=32, vgg_loss_type='L2', vgg_resize='nearest')
+    multi = MultiLayerVGGLoss([4, 9], [1., 0.5], args)
+    singles = [VGGLoss(4, args), VGGLoss(9, args)]
+    x = torch.rand(2, 3, 64, 64) * 2 - 1
+    gt = torch.rand(2, 3, 64, 64) * 2 - 1
+    with torch.no_grad():
+        expected = singles[0](x, gt) + 0.5 * singles[1](x, gt)
+        assert torch.allclose(multi(x, gt), expected, rtol=1e-5)
+        # 目标图片的features被缓存, 原地修改目标后重新计算
+        gt.mul_(0.5)
+        expected = singles[0](x, gt) + 0.5 * singles[1](x, gt)
+        assert torch.allclose(multi(x, gt), expected, rtol=1e-5)
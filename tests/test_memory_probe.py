@@ -0,0 +1,36 @@
+import logging
+
+import torch
+
+import GAN.Model_Settings as Model_Settings
+from GAN import memory_probe
+
+
+def test_safe_batch_size():
+    measurement = {'fixed': 100., 'per_sample': 50.}
+    assert memory_probe.safe_batch_size(measurement, 1100) == 20
+    assert memory_probe.safe_batch_size(measurement, 1100, max_batch_size=4) == 4
+    assert memory_probe.safe_batch_size(measurement, 10) == 1
+
+
+def test_unreliable_cpu_measurement_falls_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model_Settings, 'MEMORY_PROBE_CACHE', str(tmp_path / 'memory_probe.json'))
+    # 没有分配新内存的运行读不到每个样本的内存, 不能当作0而选择最大的batch
+    batch_size = memory_probe._pick_batch_size(lambda batch_size: None, 'cpu', {'task': 'test'}, 1 << 20, None,
+                                               1 << 40, logging.getLogger('test'), 'test')
+    assert batch_size == memory_probe.FALLBACK_BATCH_SIZE
+    assert not (tmp_path / 'memory_probe.json').exists()
+
+
+def test_cpu_measurement_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model_Settings, 'MEMORY_PROBE_CACHE', str(tmp_path / 'memory_probe.json'))
+    per_sample = 64 << 20
+
+    def run_batch(batch_size):
+        buffer = torch.ones(batch_size * per_sample // 4)     # 写入, 确保页面常驻
+        return buffer.sum()
+
+    measurement = memory_probe.probe(run_batch, 'cpu', {'task': 'test'}, per_sample // 2)
+    assert measurement is not None
+    assert per_sample * 0.9 <= measurement['per_sample'] <= per_sample * 1.5
+    assert memory_probe.probe(None, 'cpu', {'task': 'test'}) == measurement
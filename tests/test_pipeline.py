@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('postprocess', [False, True])
+def test_pipelined_synthesis_matches_serial(generator, postprocess):
+    assert not generator.pipelined      # 默认逐个batch运行
+    latent_codes = generator.easy_sample(10)
+    expected = generator.synthesize(latent_codes, postprocess=postprocess)['image']
+    batches = []
+    generator.pipelined = True
+    try:
+        images = generator.synthesize(latent_codes, postprocess=postprocess,
+                                      callback=lambda results: batches.append(len(results['z'])))['image']
+    finally:
+        generator.pipelined = False
+    assert images.dtype == expected.dtype
+    assert np.allclose(images, expected, atol=1e-5)
+    assert sorted(batches) == [2, 4, 4]
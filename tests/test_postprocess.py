@@ -0,0 +1,27 @@
+import numpy as np
+import torch
+
+from GAN.base_generator import postprocess_tensor
+from utils.manipulate import convert_array_to_images, convert_tensor_to_images
+
+
+def test_postprocess_tensor_matches_numpy(generator):
+    # 包括超出[-1, 1]的值和恰好在取整边界上的值
+    boundaries = ((torch.arange(256.) - 0.5) / 127.5 - 1.).view(1, 1, 16, 16).repeat(1, 3, 1, 1)
+    images = torch.cat([torch.randn(4, 3, 16, 16) * 1.5, boundaries], 0)
+    assert np.array_equal(generator.postprocess_tensor(images), generator.postprocess(images.numpy()))
+    assert np.array_equal(convert_tensor_to_images(images), convert_array_to_images(images.numpy()))
+    assert np.array_equal(postprocess_tensor(images, channel_order='BGR'), postprocess_tensor(images)[..., ::-1])
+
+
+def test_easy_synthesize_on_device_matches_host(generator):
+    latent_codes = generator.easy_sample(6)
+    generator.postprocess_on_device = False
+    expected = generator.easy_synthesize(latent_codes)['image']
+    generator.postprocess_on_device = True
+    try:
+        images = generator.easy_synthesize(latent_codes)['image']
+    finally:
+        generator.postprocess_on_device = False
+    assert images.dtype == np.uint8
+    assert np.array_equal(images, expected)
@@ -0,0 +1,48 @@
+import torch
+
+from Derivable_Models.Derivable_Generator import PGGAN_multi_z
+from inversion.inversion_methods import get_inversion
+
+
+def fused_feature_map(generator, z_estimate, alpha_estimate):
+    maps = [generator.pre_model(z_estimate[:, j].view((-1, generator.z_dim, 1, 1))) *
+            alpha_estimate[:, j].view((-1, generator.layer_c_number, 1, 1)) for j in range(z_estimate.size()[1])]
+    return sum(maps) / z_estimate.size()[1]
+
+
+def test_prune_codes_keeps_the_output_continuous(make_args):
+    torch.manual_seed(0)
+    args = make_args(optimization='Adam', z_number=8, prune_every=1, prune_threshold=0.1, min_codes=1)
+    generator = PGGAN_multi_z('pggan_fixture32', args.composing_layer, args.z_number, args)
+    z_estimate, alpha_estimate = generator.init_value(2, device='cpu')
+    alpha_estimate[:, 4:] = 1e-5      # 后一半codes不重要, 会被剪掉
+    latent_estimate = [z_estimate, alpha_estimate]
+    for latent in latent_estimate:
+        latent.requires_grad = True
+    optimizer = torch.optim.Adam(latent_estimate, lr=args.lr)
+    generator(latent_estimate).square().mean().backward()
+    optimizer.step()
+
+    inversion = get_inversion(args.optimization, args)
+    with torch.no_grad():
+        fused_before = fused_feature_map(generator, *latent_estimate)
+        image_before = generator.post_model(fused_before)
+    old_alpha = latent_estimate[1]
+    old_state = {key: value.clone() for key, value in optimizer.state[old_alpha].items() if torch.is_tensor(value)}
+    inversion.prune_codes(generator, latent_estimate, optimizer)
+    with torch.no_grad():
+        fused_after = fused_feature_map(generator, *latent_estimate)
+        image_after = generator.post_model(fused_after)
+
+    assert latent_estimate[0].size()[1] == 4
+    assert torch.allclose(fused_after, fused_before, rtol=1e-3, atol=1e-4 * fused_before.abs().max().item())
+    assert torch.allclose(image_after, image_before, rtol=1e-3, atol=1e-4 * image_before.abs().max().item())
+    # 剪枝后alpha的梯度放大为2倍, 优化器的动量随之缩放
+    new_state = optimizer.state[latent_estimate[1]]
+    assert torch.allclose(new_state['exp_avg'], old_state['exp_avg'][:, :4] * 2)
+    assert torch.allclose(new_state['exp_avg_sq'], old_state['exp_avg_sq'][:, :4] * 4)
+    assert old_alpha not in optimizer.state
+    # 与剪枝后的梯度一致
+    generator(latent_estimate).square().mean().backward()
+    old_grad, new_grad = old_alpha.grad[:, :4], latent_estimate[1].grad
+    assert abs((new_grad * old_grad).sum() / old_grad.square().sum() - 2) < 1e-2
@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from Derivable_Models.Derivable_Generator import PGGAN, PGGAN_multi_z_shared
+from inversion.inversion_methods import get_inversion
+
+
+def test_shared_codes_match_per_image_fusion(make_args):
+    torch.manual_seed(0)
+    args = make_args(private_z_number=2)
+    generator = PGGAN_multi_z_shared('pggan_fixture32', args.composing_layer, args.z_number, args.private_z_number,
+                                     args)
+    z_shared, alpha, z_private = generator.init_value(3, device='cpu')
+    alpha = torch.rand_like(alpha)
+    with torch.no_grad():
+        output = generator([z_shared, alpha, z_private])
+        for b in range(3):
+            codes = torch.cat([z_shared[0], z_private[b]], dim=0)
+            maps = generator.pre_model(codes.view((-1, 512, 1, 1))) * alpha[b].view(alpha.size()[1:] + (1, 1))
+            expected = generator.post_model(maps.sum(dim=0, keepdim=True) / alpha.size()[1])
+            assert torch.allclose(output[b:b + 1], expected, atol=1e-5)
+
+
+def test_pruning_is_rejected_up_front(make_args):
+    with pytest.raises(ValueError):
+        PGGAN_multi_z_shared('pggan_fixture32', 2, 4, 0, make_args(prune_every=10))
+    # 单个latent code的生成器不能剪枝, 在开始优化之前就报错
+    inversion = get_inversion('GD', make_args(prune_every=10))
+    with pytest.raises(ValueError):
+        inversion.invert(PGGAN('pggan_fixture32'), torch.zeros(1, 3, 32, 32), torch.nn.MSELoss())
+    inversion = get_inversion('GD', make_args(code_schedule='Refine'))
+    with pytest.raises(ValueError):
+        inversion.invert(PGGAN('pggan_fixture32'), torch.zeros(1, 3, 32, 32), torch.nn.MSELoss())
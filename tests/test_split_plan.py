@@ -0,0 +1,57 @@
+import torch
+
+import Derivable_Models.Gan_Utils as Gan_Utils
+from Derivable_Models.Gan_Utils import GENERATOR_REGISTRY, get_gan_model, get_split_plan
+from GAN.pggan_generator_network import PGGANGeneratorNet
+
+# 拆分表由网络设置计算之前的硬编码表
+PGGAN_LATENT_256 = [(512, 1, 1), (512, 4, 4),
+                    (512, 4, 4), (512, 8, 8),
+                    (512, 8, 8), (512, 16, 16),
+                    (512, 16, 16), (512, 32, 32),
+                    (512, 32, 32), (256, 64, 64),
+                    (256, 64, 64), (128, 128, 128),
+                    (128, 128, 128), (64, 256, 256),
+                    (64, 256, 256), (3, 256, 256)]
+PGGAN_LATENT_1024 = PGGAN_LATENT_256[:9] + [(256, 64, 64), (256, 64, 64), (128, 128, 128), (128, 128, 128),
+                                            (64, 256, 256), (64, 256, 256), (32, 512, 512), (32, 512, 512),
+                                            (16, 1024, 1024), (16, 1024, 1024), (3, 1024, 1024)]
+# 之前去除中间分辨率输出层时删除的序号
+PGGAN_Inter_Output_Layer_256 = [-1, 17, 14, 11, 8, 5, 2]
+
+
+def test_plan_matches_hardcoded_tables():
+    assert get_split_plan('pggan_bedroom')['shapes'] == PGGAN_LATENT_256
+    assert get_split_plan('pggan_celebahq')['shapes'] == PGGAN_LATENT_1024
+
+
+def test_plan_builds_no_network(monkeypatch):
+    def build(*args, **kwargs):
+        raise AssertionError('The network should not be built!')
+    monkeypatch.setattr(Gan_Utils, '_SPLIT_PLANS', {})
+    monkeypatch.setattr(PGGANGeneratorNet, '__init__', build)
+    assert get_split_plan('pggan_celebahq')['shapes'] == PGGAN_LATENT_1024
+
+
+def test_plan_matches_network():
+    net = GENERATOR_REGISTRY.get('pggan_fixture32').net
+    assert get_split_plan('pggan_fixture32')['layer_names'] == [name for name, _ in net.get_composing_layers()]
+    assert PGGANGeneratorNet(resolution=64).get_composing_layers() == \
+        Gan_Utils.get_composing_layers(64)
+
+
+def test_plan_layers_match_removed_outputs():
+    net = PGGANGeneratorNet(resolution=256)
+    layers = list(net.children())
+    for output_index in PGGAN_Inter_Output_Layer_256:
+        layers.pop(output_index)
+    plan = get_split_plan('pggan_bedroom')
+    assert [getattr(net, name) for name in plan['layer_names']] == layers
+
+
+def test_composed_layers_match_generator():
+    gan = get_gan_model('pggan_fixture32')
+    net = GENERATOR_REGISTRY.get('pggan_fixture32').net
+    z = torch.randn(2, net.z_space_dim)
+    with torch.no_grad():
+        assert torch.allclose(gan(z.view(2, -1, 1, 1)), net(z), atol=1e-5)
@@ -1,6 +1,5 @@
 import os
 from PIL import Image
-import torchvision
 
 # 可识别的图片后缀名
 IMG_EXTENSIONS = ['jpg', 'jpeg', 'png', 'ppm', 'bmp', 'pgm']
@@ -37,12 +36,15 @@ def load_as_tensor(path, mode='RGB'):
         return PIL2Tensor(pil_loader(path, mode='YCbCr'))[:1]
 
  # PIL image和tensor互化
+# torchvision推迟到第一次使用时导入, 加快启动
 def PIL2Tensor(pil_image):
+    import torchvision.transforms.functional
     return torchvision.transforms.functional.to_tensor(pil_image)   # Convert a tensor or an ndarray to PIL Image.
 
 def Tensor2PIL(tensor_image, mode='RGB'):
     if len(tensor_image.size()) == 4 and tensor_image.size()[0] == 1:
         tensor_image = tensor_image.view(tensor_image.size()[1:])
+    import torchvision.transforms.functional
     return torchvision.transforms.functional.to_pil_image(tensor_image.detach(), mode=mode)
 
 # 根据后缀判断是否为图片
@@ -0,0 +1,44 @@
+import torch
+import torch.nn.functional as F
+
+
+# 图像质量评价指标, 输入为值域[0, 1]的tensor, 尺寸为[batch_size, channel, height, width]
+def psnr(x, gt, max_val=1.):
+    """
+    Peak signal-to-noise ratio of every image in the batch.
+    :param x: estimated images, range [0, max_val]
+    :param gt: ground truth images, range [0, max_val]
+    :return: 1D tensor of size batch_size, in dB
+    """
+    mse = ((x - gt) ** 2).flatten(1).mean(dim=1)
+    return 10. * torch.log10(max_val ** 2 / mse.clamp(min=1e-12))
+
+
+def _gaussian_window(size, sigma, channels, device, dtype):
+    coords = torch.arange(size, device=device, dtype=dtype) - (size - 1) / 2.
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    return (g[:, None] * g[None, :]).expand(channels, 1, size, size).contiguous()
+
+
+def ssim(x, gt, max_val=1., window_size=11, sigma=1.5):
+    """
+    Structural similarity of every image in the batch, with a gaussian window (Wang et al. 2004).
+    Computed on every channel separately and averaged.
+    :param x: estimated images, range [0, max_val]
+    :param gt: ground truth images, range [0, max_val]
+    :return: 1D tensor of size batch_size
+    """
+    channels = x.size()[1]
+    window = _gaussian_window(window_size, sigma, channels, x.device, x.dtype)
+    # 分组卷积, 每个channel单独计算局部均值/方差/协方差
+    def filter2d(t):
+        return F.conv2d(t, window, groups=channels)
+    mu_x, mu_gt = filter2d(x), filter2d(gt)
+    var_x = filter2d(x * x) - mu_x ** 2
+    var_gt = filter2d(gt * gt) - mu_gt ** 2
+    covar = filter2d(x * gt) - mu_x * mu_gt
+    c1, c2 = (0.01 * max_val) ** 2, (0.03 * max_val) ** 2
+    ssim_map = ((2 * mu_x * mu_gt + c1) * (2 * covar + c2)) / \
+               ((mu_x ** 2 + mu_gt ** 2 + c1) * (var_x + var_gt + c2))
+    return ssim_map.flatten(1).mean(dim=1)
@@ -40,6 +40,15 @@ def convert2target(image, mode='bilinear'):
         img = F.interpolate(image, scale_factor=pre_factor, mode=mode)
     return img
 
+# 原生低分辨率的超分辨率: 不放大输入图片, 只计算生成器输出需要缩小的倍数
+def get_sr_factor(image, resolution=1024):
+    height, weight = image.size()[2], image.size()[3]       # 获取图片维度信息
+    if(height != weight):
+        raise ValueError('error input img size! 请确保输入图片是正方形!')
+    if(height > resolution or resolution % height != 0):
+        raise ValueError('error input img size! 请确保输入图片分辨率是%d的因子!' % resolution)
+    return resolution // height
+
 # 测试
 def convert_test(image, factor, mode='nearest'):
      # print("img: ", image.size())      # torch.Size([1, 3, 1024, 1024])
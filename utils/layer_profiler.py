@@ -0,0 +1,192 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+
+# 逐层性能分析
+# 在模块上注册forward/backward hooks, 统计每层的耗时、FLOPs估计和激活值(输出)占用的内存, 并记录Chrome trace
+# 每个hook都会同步设备, 会拖慢运行, 只在需要分析时打开
+class LayerProfiler(object):
+    def __init__(self, device=None, trace_limit=200000):
+        """
+        :param device: device to synchronize before every timestamp. None for the current cuda device if available
+        :param trace_limit: max number of events kept for the Chrome trace, the statistics are always complete
+        """
+        self.device = device
+        self.trace_limit = trace_limit
+        self.stats = OrderedDict()      # name -> 统计
+        self.events = []
+        self.handles = []
+        self.stack = []         # 正在前向传播的模块, 用于把子模块的FLOPs累加到父模块
+        self.backward_start = {}        # name -> 反向传播开始时间的栈, 一次前向传播中可能多次调用同一个模块
+        self.relu_inplace = {}      # 关闭了inplace的ReLU -> 原来的inplace, detach()时恢复
+        self.origin = time.perf_counter()
+
+    def _sync(self):
+        if torch.cuda.is_available() and (self.device is None or torch.device(self.device).type == 'cuda'):
+            torch.cuda.synchronize(self.device)
+
+    def _now(self):
+        self._sync()
+        return time.perf_counter()
+
+    def _stat(self, name):
+        if name not in self.stats:
+            self.stats[name] = {'calls': 0, 'forward_s': 0., 'backward_calls': 0, 'backward_s': 0.,
+                                'flops': 0, 'activation_bytes': 0}
+        return self.stats[name]
+
+    def _event(self, name, phase, start, end, args=None):
+        if len(self.events) < self.trace_limit:
+            self.events.append({'name': name, 'cat': phase, 'ph': 'X', 'pid': 0,
+                                'tid': 0 if phase == 'forward' else 1,
+                                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6,
+                                'args': args or {}})
+
+    def attach(self, module, name):
+        """
+        Profiles the forward and backward of `module` under `name`.
+        """
+        # 反向传播hooks与inplace操作冲突, 分析期间关闭inplace ReLU
+        for m in module.modules():
+            if isinstance(m, nn.ReLU):
+                self.relu_inplace.setdefault(m, m.inplace)
+                m.inplace = False
+
+        def forward_pre_hook(m, inputs):
+            self.stack.append([name, self._now(), 0])
+
+        def forward_hook(m, inputs, output):
+            _, start, children_flops = self.stack.pop()
+            end = self._now()
+            flops = estimate_flops(m, inputs, output) or children_flops
+            activation = tensor_bytes(output)
+            stat = self._stat(name)
+            stat['calls'] += 1
+            stat['forward_s'] += end - start
+            stat['flops'] += flops
+            stat['activation_bytes'] += activation
+            if self.stack:
+                self.stack[-1][2] += flops
+            self._event(name, 'forward', start, end, {'flops': flops, 'activation_bytes': activation})
+
+        def backward_pre_hook(m, grad_output):
+            self.backward_start.setdefault(name, []).append(self._now())
+
+        def backward_hook(m, grad_input, grad_output):
+            if not self.backward_start.get(name):
+                return
+            start = self.backward_start[name].pop()
+            end = self._now()
+            stat = self._stat(name)
+            stat['backward_calls'] += 1
+            stat['backward_s'] += end - start
+            self._event(name, 'backward', start, end)
+
+        self.handles.append(module.register_forward_pre_hook(forward_pre_hook))
+        self.handles.append(module.register_forward_hook(forward_hook))
+        if hasattr(module, 'register_full_backward_pre_hook'):      # torch 2.0之后才有, 否则不统计反向传播
+            self.handles.append(module.register_full_backward_pre_hook(backward_pre_hook))
+            self.handles.append(module.register_full_backward_hook(backward_hook))
+        return self
+
+    def attach_generator(self, generator):
+        """
+        Profiles `pre_model` / `post_model` of the multi-code generators and every conv block (any module with
+        a `pixel_norm`, i.e. `ConvBlock` of PGGAN).
+        """
+        for name in ['pre_model', 'post_model']:
+            if hasattr(generator, name):
+                self.attach(getattr(generator, name), name)
+        seen = set()
+        for name, module in generator.named_modules():
+            if hasattr(module, 'pixel_norm') and id(module) not in seen:    # pre_model和pggan共享同一些层
+                seen.add(id(module))
+                self.attach(module, name)
+        return self
+
+    def attach_loss(self, loss):
+        """
+        Profiles every perceptual network (modules with `features`) and each of its layers.
+        """
+        for name, module in loss.named_modules():
+            if isinstance(getattr(module, 'features', None), nn.Sequential):
+                self.attach(module, name or 'vgg')
+                for index, layer in enumerate(module.features):
+                    self.attach(layer, '%s.%d:%s' % (name or 'vgg', index, type(layer).__name__))
+        return self
+
+    def detach(self):
+        """
+        Removes the hooks and restores the inplace ReLUs.
+        """
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for m, inplace in self.relu_inplace.items():
+            m.inplace = inplace
+        self.relu_inplace = {}
+        self.backward_start = {}
+
+    def table(self):
+        """
+        :return: the statistics as a text table, sorted by the total time
+        """
+        total = sum(s['forward_s'] + s['backward_s'] for s in self.stats.values()) or 1.
+        rows = sorted(self.stats.items(), key=lambda item: item[1]['forward_s'] + item[1]['backward_s'],
+                      reverse=True)
+        lines = ['%-40s %7s %12s %12s %8s %12s %12s' % ('layer', 'calls', 'fwd ms/call', 'bwd ms/call', 'time %',
+                                                      'GFLOPs/call', 'act MB/call')]
+        for name, s in rows:
+            calls = max(s['calls'], 1)
+            lines.append('%-40s %7d %12.3f %12.3f %8.1f %12.3f %12.2f'
+                         % (name, s['calls'], 1000 * s['forward_s'] / calls,
+                            1000 * s['backward_s'] / max(s['backward_calls'], 1),
+                            100 * (s['forward_s'] + s['backward_s']) / total,
+                            s['flops'] / calls / 1e9, s['activation_bytes'] / calls / 2 ** 20))
+        lines.append('Nested modules (pre_model/post_model, the perceptual networks) include their layers, '
+                     'so the percentages overlap.')
+        return '\n'.join(lines)
+
+    def save(self, table_path=None, trace_path=None):
+        """
+        Writes the table and the Chrome trace (open with chrome://tracing or Perfetto).
+        """
+        if table_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(table_path)), exist_ok=True)
+            with open(table_path, 'w') as f:
+                f.write(self.table() + '\n')
+        if trace_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+            with open(trace_path, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+def tensor_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (list, tuple)):
+        return sum(tensor_bytes(o) for o in output)
+    return 0
+
+
+# 卷积/全连接层的乘加次数 * 2, 其余的逐元素操作忽略不计. 不能估计的返回0
+def estimate_flops(module, inputs, output):
+    if not isinstance(output, torch.Tensor):
+        return 0
+    if isinstance(module, nn.Conv2d):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        return 2 * output.numel() * kernel
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+    # PGGAN的ConvBlock
+    if getattr(module, 'use_conv2d_transpose', False):
+        kernel_size, _, in_channels, _ = module.weight.shape
+        return 2 * output.numel() * in_channels * kernel_size * kernel_size
+    if isinstance(getattr(module, 'conv', None), nn.Conv2d):
+        return estimate_flops(module.conv, inputs, output)
+    return 0
@@ -1,5 +1,4 @@
 import numpy as np
-import cv2
 from math import sqrt, ceil
 from PIL import Image
 
@@ -12,6 +11,7 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '..'))
 
 from utils.file_utils import Tensor2PIL, PIL2Tensor
 from utils.image_precossing import _add_batch_one
+from GAN.base_generator import postprocess_tensor
 
 
 BOUNDARY_DIR = './boundaries'
@@ -37,6 +37,49 @@ def SR_loss(loss_function, down_type='bilinear', factor=8):     # mode默认为
     return loss
 
 
+# 只对生成器的输出下采样, 目标图片保持原生的低分辨率
+# 下采样用预先计算好的卷积核做步长为factor的卷积, 结果与F.interpolate(x, scale_factor=1/factor, mode=down_type)一致
+def SR_native_loss(loss_function, down_type='bilinear', factor=8):
+    kernels = {}
+
+    def loss(x, gt):
+        if factor > 1:
+            if down_type not in DOWNSAMPLE_KERNEL_MODES:
+                x = F.interpolate(x, scale_factor=1/factor, mode=down_type)
+            else:
+                key = (x.device, x.dtype, x.size()[1])
+                if key not in kernels:
+                    kernels[key] = downsample_kernel(factor, down_type, x.size()[1]).to(device=x.device, dtype=x.dtype)
+                x = F.conv2d(x, kernels[key], stride=factor, groups=x.size()[1])
+        return loss_function(x, gt)
+    return loss
+
+
+DOWNSAMPLE_KERNEL_MODES = ['nearest', 'bilinear', 'area']
+
+
+def downsample_kernel(factor, mode='bilinear', channels=3):
+    """
+    Depthwise kernel of size [channels, 1, factor, factor], used as a conv with stride `factor`, equals to
+    F.interpolate(x, scale_factor=1/factor, mode=mode) (align_corners=False).
+    """
+    weight = torch.zeros(factor)
+    if mode == 'nearest':       # 取每个块的第一个像素
+        weight[0] = 1.
+    elif mode == 'area':        # 块内求均值
+        weight[:] = 1. / factor
+    elif mode == 'bilinear':    # 采样点位于块中心, 由中心两侧的像素插值
+        center = (factor - 1) / 2.
+        left = int(center)
+        weight[left] = 1. - (center - left)
+        if center > left:
+            weight[left + 1] = center - left
+    else:
+        raise ValueError('Unsupported downsampling mode `%s`!' % mode)
+    kernel = weight[:, None] * weight[None, :]
+    return kernel.expand(channels, 1, factor, factor).contiguous()
+
+
 def upsample_images(image, factor=4, mode='nearest', size=256):
     """
     默认将256x256的图片放大到1024
@@ -87,6 +130,16 @@ def convert_array_to_images(np_array):
   return images
 
 
+
+def convert_tensor_to_images(tensor):
+  """Same as `convert_array_to_images()` but takes a `torch.Tensor`.
+
+  The conversion runs on the device of the tensor and only the `uint8` images
+  are copied to host. NOTE: the channel order will be the same as input.
+  """
+  return postprocess_tensor(tensor.detach())
+
+
 def style_mixing(source_A, source_B, level):
     """
     :param source_A: of size [1, 18, 512]